@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+'''
+    Benchmark MultiNER on the bundled corpus of KB OCR samples, against
+    the stand-in Stanford and Spotlight servers of stub_servers.py.
+
+    Reports the throughput, and the p50/p95/p99 latency end to end and
+    per engine (the time an engine took for all parts of a request).
+
+    In-process, ner.process() is called directly, from --concurrency
+    threads, with the result cache disabled:
+
+        $ python3 bench/bench.py --requests 500 --concurrency 16 \\
+                --engines stanford,spotlight --latency 0.05
+
+    With --url, the requests go to a running service, which fetches the
+    corpus from the stand-ins, start it with its Stanford and Spotlight
+    backends pointing to --stanford-port and --spotlight-port, and its
+    result cache disabled (CACHE_MEMORY_BYTES = 0):
+
+        $ python3 bench/bench.py --url http://localhost:8099/
+'''
+
+import argparse
+import concurrent.futures
+import functools
+import math
+import os
+import sys
+import time
+
+import requests
+
+# ner.py lives one directory up.
+sys.path.insert(0,
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ner
+
+from stub_servers import CORPUS_DIR, add_arguments, start_stubs, stub_config
+
+
+def percentile(values, p):
+    '''
+        Nearest-rank percentile.
+
+        >>> percentile([0.4, 0.1, 0.3, 0.2], 50)
+        0.2
+        >>> percentile([0.4, 0.1, 0.3, 0.2], 99)
+        0.4
+    '''
+    values = sorted(values)
+    if not values:
+        return None
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+
+
+def load_corpus(corpus_dir, repeat=1):
+    '''
+        The OCR samples as {name: parsed_text}, every part repeated
+        `repeat` times, to simulate long newspaper pages.
+    '''
+    corpus = {}
+    for name in sorted(os.listdir(corpus_dir)):
+        if not name.endswith('.xml'):
+            continue
+        with open(os.path.join(corpus_dir, name), 'rb') as fh:
+            parsed_text = ner.xml_to_dict(fh.read())
+        corpus[name] = {part: ' '.join([parsed_text[part]] * repeat)
+                        for part in parsed_text}
+    return corpus
+
+
+def run_local(name, corpus, engines, deadline):
+    return ner.process(corpus[name],
+                       deadline=time.time() + deadline,
+                       engines=engines)
+
+
+def run_remote(name, url, corpus_url, engines, deadline):
+    response = requests.get(url, params={"url": corpus_url + name,
+                                         "engines": ','.join(engines),
+                                         "deadline": deadline},
+                            timeout=deadline + 30)
+    response.raise_for_status()
+    return response.json()
+
+
+def run(job, names, requests_count, concurrency):
+    '''
+        Run requests_count jobs over names, returns the wall time,
+        and per request (latency, answer, or None if it failed).
+    '''
+    def timed(name):
+        start_time = time.time()
+        try:
+            answer = job(name)
+        except Exception:
+            answer = None
+        return time.time() - start_time, answer
+
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(timed, [names[i % len(names)]
+                                            for i in range(requests_count)]))
+    return time.time() - start_time, results
+
+
+def report(results, engines, wall):
+    lines = ['%d requests in %.2fs, %.1f requests/s' % (
+        len(results), wall, len(results) / wall),
+        '',
+        '%-12s %7s %9s %9s %9s  %s' % ('', 'n', 'p50', 'p95', 'p99',
+                                       'missing')]
+
+    def row(label, latencies, missing):
+        values = [percentile(latencies, p) for p in (50, 95, 99)]
+        line = '%-12s %7d %s  %s' % (
+            label,
+            len(latencies),
+            ' '.join('%9s' % ('-' if value is None else '%.4f' % value)
+                     for value in values),
+            ', '.join('%s=%d' % item for item in sorted(missing.items())))
+        lines.append(line.rstrip())
+
+    answers = [answer for _, answer in results if answer is not None]
+    row('end-to-end',
+        [latency for latency, answer in results if answer is not None],
+        {"failed": len(results) - len(answers)} if
+        len(answers) < len(results) else {})
+
+    for engine in engines:
+        latencies = []
+        missing = {}
+        for answer in answers:
+            reason = answer.get("missing", {}).get(engine)
+            if reason:
+                missing[reason] = missing.get(reason, 0) + 1
+            elif "timing_" + engine in answer.get("timing", {}):
+                latencies.append(answer["timing"]["timing_" + engine])
+        row(engine, latencies, missing)
+
+    return '\n'.join(lines)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--engines', default='spotlight,stanford',
+                        help='engines or profile (default: %(default)s)')
+    parser.add_argument('--deadline', type=float, default=30,
+                        help='deadline per request in seconds')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='repeat every part, for long texts '
+                             '(in-process only)')
+    parser.add_argument('--warm-up', type=int, default=1,
+                        help='untimed rounds over the corpus first')
+    parser.add_argument('--corpus', default=CORPUS_DIR)
+    parser.add_argument('--url', default=None,
+                        help='benchmark a running service instead')
+    parser.add_argument('--stanford-port', type=int, default=None,
+                        help='default: 9092 with --url, else a free port')
+    parser.add_argument('--spotlight-port', type=int, default=None,
+                        help='default: 9091 with --url, else a free port')
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    engines = ner.select_engines(args.engines)
+
+    if args.url:
+        stanford_port = args.stanford_port or 9092
+        spotlight_port = args.spotlight_port or 9091
+    else:
+        stanford_port = args.stanford_port or 0
+        spotlight_port = args.spotlight_port or 0
+
+    stanford, spotlight = start_stubs(stub_config(args),
+                                      stanford_port,
+                                      spotlight_port,
+                                      args.corpus)
+
+    corpus = load_corpus(args.corpus, args.repeat)
+    names = list(corpus)
+
+    if args.url:
+        if args.repeat != 1:
+            parser.error('--repeat only works in-process')
+        corpus_url = 'http://127.0.0.1:%d/corpus/' % (
+                spotlight.server_address[1])
+        job = functools.partial(run_remote,
+                                url=args.url,
+                                corpus_url=corpus_url,
+                                engines=engines,
+                                deadline=args.deadline)
+    else:
+        ner.STANFORD_BACKENDS = [('127.0.0.1', stanford.server_address[1])]
+        ner.SPOTLIGHT_BACKENDS = [('127.0.0.1', spotlight.server_address[1])]
+        ner.CACHE_MEMORY_BYTES = 0
+        ner.CACHE_DB = None
+        job = functools.partial(run_local,
+                                corpus=corpus,
+                                engines=engines,
+                                deadline=args.deadline)
+
+    characters = sum(len(text) for parsed_text in corpus.values()
+                     for text in parsed_text.values())
+    print('corpus: %d documents, %d characters, engines: %s' % (
+        len(corpus), characters, ', '.join(engines)))
+
+    if args.warm_up:
+        run(job, names, args.warm_up * len(names), args.concurrency)
+
+    wall, results = run(job, names, args.requests, args.concurrency)
+    print(report(results, engines, wall))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+'''
+    Microbenchmark of intergrate_results() and context(), on synthetic
+    engine outputs, over a range of text sizes and entity densities.
+
+    For every density, the growth of the cost with the text size is
+    fitted as cost ~ size ** exponent. With a fixed density, the number of
+    entities grows with the text, so linear work per entity shows up as
+    an exponent of about 1, and work per entity over the whole text as
+    about 2. Exits with 1 if an exponent exceeds --max-exponent:
+
+        $ python3 bench/bench_integration.py --sizes 1000,8000,64000
+'''
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+# ner.py lives one directory up.
+sys.path.insert(0,
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ner
+
+WORDS = ("de", "het", "een", "van", "en", "in", "te", "dat", "op", "is",
+         "met", "voor", "niet", "aan", "zijn", "werd", "door", "bij",
+         "gisteren", "vergadering", "regeering", "stoomschip", "markt",
+         "gemeente", "tentoonstelling", "verkeer", "brand", "spoorlijn")
+
+PUNCTUATION = ("", "", "", "", ",", ".", "!", '"')
+
+NAMES = ("Amsterdam", "Rotterdam", "Leiden", "Thorbecke", "Troelstra",
+         "Lorentz", "Wilhelmina", "Rijksmuseum", "Berlijn", "Londen")
+
+TYPES = ("location", "person", "organisation", "other")
+
+# Fraction of the entities that each engine finds.
+ENGINE_SHARE = {"stanford": 0.8,
+                "spotlight": 0.6,
+                "spacy": 0.7,
+                "polyglot": 0.5,
+                "flair": 0.8}
+
+
+def synthetic_part(characters, density, seed=0):
+    '''
+        A text of about `characters` characters, with `density` entities
+        per 1000 characters, and the engine results for it.
+
+        >>> text, result = synthetic_part(2000, 10)
+        >>> all(text[ne["pos"]:].startswith(ne["ne"])
+        ...     for engine in result for ne in result[engine])
+        True
+    '''
+    rng = random.Random(seed)
+
+    words = []
+    size = 0
+    while size < characters:
+        words.append(rng.choice(WORDS) + rng.choice(PUNCTUATION))
+        size += len(words[-1]) + 1
+
+    count = min(max(int(characters * density / 1000.0), 1), len(words))
+    indexes = set(rng.sample(range(len(words)), count))
+
+    entities = []
+    pos = 0
+    for i, word in enumerate(words):
+        if i in indexes:
+            words[i] = rng.choice(NAMES)
+            entities.append({"ne": words[i],
+                             "pos": pos,
+                             "type": rng.choice(TYPES)})
+        pos += len(words[i]) + 1
+
+    result = {}
+    for engine, share in sorted(ENGINE_SHARE.items()):
+        result[engine] = [dict(ne) for ne in entities if rng.random() < share]
+
+    return ' '.join(words), result
+
+
+def best_time(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start_time
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def scaling_exponent(sizes, costs):
+    '''
+        Least squares slope of log(cost) over log(size).
+
+        >>> round(scaling_exponent([1, 2, 4, 8], [3, 12, 48, 192]), 2)
+        2.0
+    '''
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(cost) for cost in costs]
+    x_mean = sum(xs) / len(xs)
+    y_mean = sum(ys) / len(ys)
+    return (sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) /
+            sum((x - x_mean) ** 2 for x in xs))
+
+
+def measure(characters, density, context_len, repeat):
+    '''
+        Seconds for intergrate_results(), and for only the context() calls
+        it makes (with one TokenIndex for the part), on one synthetic part.
+    '''
+    text, result = synthetic_part(characters, density)
+
+    answer = ner.intergrate_results(result, False, text, context_len)
+
+    integrate = best_time(
+            lambda: ner.intergrate_results(result, False, text, context_len),
+            repeat)
+
+    def contexts():
+        index = ner.TokenIndex(text)
+        return [ner.context(text, ne["ne"], ne["pos"], context_len, index)
+                for ne in answer]
+
+    context = best_time(contexts, repeat)
+
+    return len(answer), integrate, context
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', default='1000,4000,16000,64000',
+                        help='text sizes in characters')
+    parser.add_argument('--densities', default='2,10,40',
+                        help='entities per 1000 characters')
+    parser.add_argument('--context', type=int, default=5,
+                        help='context tokens (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per measurement, the best one counts')
+    parser.add_argument('--max-exponent', type=float, default=1.5,
+                        help='fail above this scaling exponent')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    densities = [float(density) for density in args.densities.split(',')]
+
+    print('%8s %10s %9s %14s %12s' % ('density', 'characters', 'entities',
+                                      'integrate ms', 'context ms'))
+
+    failed = False
+    exponents = []
+    for density in densities:
+        integrate_costs = []
+        context_costs = []
+        for size in sizes:
+            entities, integrate, context = measure(size, density,
+                                                   args.context, args.repeat)
+            integrate_costs.append(integrate)
+            context_costs.append(context)
+            print('%8g %10d %9d %14.3f %12.3f' % (density, size, entities,
+                                                   integrate * 1000,
+                                                   context * 1000))
+
+        for label, costs in (('integrate', integrate_costs),
+                             ('context', context_costs)):
+            exponent = scaling_exponent(sizes, costs)
+            flag = ''
+            if exponent > args.max_exponent:
+                flag = 'QUADRATIC' if exponent > 1.8 else 'SUPERLINEAR'
+                failed = True
+            exponents.append('density %g, %s: %.2f %s' % (density, label,
+                                                         exponent, flag))
+
+    print('')
+    print('scaling exponents (cost ~ size ** exponent):')
+    for line in exponents:
+        print('  ' + line.rstrip())
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
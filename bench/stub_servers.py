@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+'''
+    Stand-in servers for the external NER's, to benchmark MultiNER
+    without the Stanford and Spotlight JVMs and without internet access.
+
+    - Stanford NERServer socket protocol: one line of text per connection,
+      answered in inlineXML, after which the server closes the connection.
+    - DBpedia Spotlight /rest/annotate JSON API (GET or POST form data).
+    - The corpus: GET /corpus/<name>.xml on the Spotlight port answers
+      the OCR XML of bench/corpus/<name>.xml, like resolver.kb.nl does.
+
+    Both find the names of a small gazetteer, after a configurable delay,
+    and fail a configurable fraction of the calls:
+
+        $ python3 bench/stub_servers.py --stanford-port 9092 \\
+                --spotlight-port 9091 --latency 0.05 --error-rate 0.01
+'''
+
+import argparse
+import http.server
+import json
+import os
+import random
+import re
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'corpus')
+
+# Names the stand-ins recognize, with their Stanford (CoNLL) type.
+GAZETTEER = {"Abraham Kuyper": "PER",
+             "Albert Einstein": "PER",
+             "Amsterdam": "LOC",
+             "Berlijn": "LOC",
+             "Den Haag": "LOC",
+             "Duitschland": "LOC",
+             "Engeland": "LOC",
+             "Haarlem": "LOC",
+             "Hendrik Lorentz": "PER",
+             "Holland-Amerika Lijn": "ORG",
+             "Kamerlingh Onnes": "PER",
+             "Koningin Wilhelmina": "PER",
+             "Laurens Janszoon Coster": "PER",
+             "Leiden": "LOC",
+             "Londen": "LOC",
+             "Maas": "LOC",
+             "Nederland": "LOC",
+             "Nederlandsche Bank": "ORG",
+             "Parijs": "LOC",
+             "Prins Hendrik": "PER",
+             "Rijksmuseum": "ORG",
+             "Rijn": "LOC",
+             "Rotterdam": "LOC",
+             "Thorbecke": "PER",
+             "Troelstra": "PER",
+             "Tweede Kamer": "ORG",
+             "Utrecht": "LOC",
+             "Zuiderzee": "LOC"}
+
+GAZETTEER_RE = re.compile(r'\b(%s)\b' % '|'.join(
+        re.escape(name) for name in sorted(GAZETTEER, key=len, reverse=True)))
+
+
+class StubConfig(object):
+    '''
+        Latency and error injection of a stand-in server.
+
+        Every call takes `latency` seconds (normally distributed, with
+        standard deviation `jitter`), a fraction `slow_rate` of the calls
+        takes `slow_latency` seconds instead, and a fraction `error_rate`
+        of the calls fails.
+    '''
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0,
+                 slow_rate=0.0, slow_latency=1.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        with self._lock:
+            if self._random.random() < self.slow_rate:
+                seconds = self.slow_latency
+            else:
+                seconds = self._random.gauss(self.latency, self.jitter)
+        time.sleep(max(seconds, 0))
+
+    def fail(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+
+def find_names(text):
+    '''
+        The gazetteer names in text, as (name, offset, type).
+
+        >>> find_names("Prof. Albert Einstein sprak te Leiden.")
+        [('Albert Einstein', 6, 'PER'), ('Leiden', 31, 'LOC')]
+    '''
+    return [(match.group(0), match.start(), GAZETTEER[match.group(0)])
+            for match in GAZETTEER_RE.finditer(text)]
+
+
+def inline_xml(text):
+    '''
+        The text with the names tagged in inlineXML, B- on the first
+        token of a name, I- on the others.
+
+        >>> inline_xml("Albert Einstein.")
+        '<B-PER>Albert</B-PER> <I-PER>Einstein</I-PER>.'
+
+        Which MultiNER reads back as the gazetteer names:
+
+        >>> import ner
+        >>> text = "Prof. Albert Einstein sprak te Leiden."
+        >>> [(ne["ne"], ne["pos"], ne["type"])
+        ...  for ne in ner.stanford_result(text, inline_xml(text))]
+        [('Albert Einstein', 6, 'person'), ('Leiden', 31, 'location')]
+        >>> text = "Koningin Wilhelmina en Z.K.H. Prins Hendrik te Leiden."
+        >>> [(ne["ne"], ne["pos"])
+        ...  for ne in ner.stanford_result(text, inline_xml(text))]
+        ... # doctest: +NORMALIZE_WHITESPACE
+        [('Koningin Wilhelmina', 0), ('Prins Hendrik', 30),
+         ('Leiden', 47)]
+    '''
+    def tag(match):
+        ne_type = GAZETTEER[match.group(0)]
+        return ' '.join('<%s-%s>%s</%s-%s>' % (
+                            'I' if i else 'B', ne_type, token,
+                            'I' if i else 'B', ne_type)
+                        for i, token in enumerate(match.group(0).split()))
+
+    return GAZETTEER_RE.sub(tag, text)
+
+
+def annotate(text, confidence="0.9"):
+    '''
+        The Spotlight JSON answer for text.
+
+        >>> annotate("Te Leiden.")["Resources"][0]["@offset"]
+        '3'
+    '''
+    result = {"@text": text,
+              "@confidence": confidence,
+              "@support": "0",
+              "@types": "",
+              "@sparql": "",
+              "@policy": "whitelist"}
+
+    resources = []
+    for name, offset, _ in find_names(text):
+        resources.append({"@URI": "http://nl.dbpedia.org/resource/" +
+                                  name.replace(' ', '_'),
+                          "@support": "100",
+                          "@types": "",
+                          "@surfaceForm": name,
+                          "@offset": str(offset),
+                          "@similarityScore": "0.99",
+                          "@percentageOfSecondRank": "0.0"})
+
+    # Spotlight leaves out Resources if nothing was found.
+    if resources:
+        result["Resources"] = resources
+
+    return result
+
+
+class StanfordHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        text = self.rfile.readline().decode('utf-8')
+
+        self.server.config.delay()
+
+        if self.server.config.fail():
+            # Reset the connection, instead of closing it cleanly.
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                       struct.pack('ii', 1, 0))
+            return
+
+        self.wfile.write(inline_xml(text).encode('utf-8'))
+
+
+class SpotlightHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # The headers and the body are separate writes, on a keep-alive
+    # connection Nagle's algorithm would hold back the body until the
+    # client's delayed ACK, some 40 ms per call.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+
+        if url.path.startswith('/corpus/'):
+            self.corpus(os.path.basename(url.path))
+            return
+
+        self.annotate(urllib.parse.parse_qs(url.query))
+
+    def do_POST(self):
+        size = int(self.headers.get('Content-Length') or 0)
+        self.annotate(urllib.parse.parse_qs(
+                self.rfile.read(size).decode('utf-8')))
+
+    def annotate(self, args):
+        self.server.config.delay()
+
+        if self.server.config.fail():
+            self.send_body(500, b'Internal Server Error', 'text/plain')
+            return
+
+        body = json.dumps(annotate(args.get('text', [''])[0],
+                                   args.get('confidence', ['0.9'])[0]))
+        self.send_body(200, body.encode('utf-8'), 'application/json')
+
+    def corpus(self, name):
+        path = os.path.join(self.server.corpus_dir, name)
+        if not os.path.isfile(path):
+            self.send_body(404, b'Not Found', 'text/plain')
+            return
+
+        with open(path, 'rb') as fh:
+            self.send_body(200, fh.read(), 'text/xml')
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class StubHTTPServer(http.server.ThreadingHTTPServer):
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+def start_stubs(config, stanford_port=0, spotlight_port=0,
+                corpus_dir=CORPUS_DIR, host='127.0.0.1'):
+    '''
+        Start the Stanford and Spotlight stand-ins in background threads,
+        port 0 picks a free port. Returns the two servers,
+        their port is server.server_address[1].
+    '''
+    stanford = StubServer((host, stanford_port), StanfordHandler)
+    stanford.config = config
+
+    spotlight = StubHTTPServer((host, spotlight_port), SpotlightHandler)
+    spotlight.config = config
+    spotlight.corpus_dir = corpus_dir
+
+    for server in (stanford, spotlight):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return stanford, spotlight
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds per call (default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0.005,
+                        help='standard deviation of the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of the calls that fail')
+    parser.add_argument('--slow-rate', type=float, default=0.0,
+                        help='fraction of the calls that take --slow-latency')
+    parser.add_argument('--slow-latency', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=None)
+
+
+def stub_config(args):
+    return StubConfig(args.latency, args.jitter, args.error_rate,
+                      args.slow_rate, args.slow_latency, args.seed)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--stanford-port', type=int, default=9092)
+    parser.add_argument('--spotlight-port', type=int, default=9091)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--corpus', default=CORPUS_DIR,
+                        help='directory served under /corpus/')
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    stanford, spotlight = start_stubs(stub_config(args),
+                                      args.stanford_port,
+                                      args.spotlight_port,
+                                      args.corpus,
+                                      args.host)
+
+    print('Stanford on %s:%d, Spotlight and corpus on http://%s:%d/' % (
+        args.host, stanford.server_address[1],
+        args.host, spotlight.server_address[1]))
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,29 @@
+# Gunicorn settings for MultiNER.
+#
+# The models are loaded once in the master (preload_app), and shared
+# copy-on-write by the forked workers, so N workers need about the memory
+# of one:
+#
+#     $ gunicorn -c gunicorn.conf.py ner:application
+#
+import os
+
+bind = ':8099'
+# Every worker keeps its own /metrics, labelled with its pid, and a
+# scrape reaches one of them, sum over pid (see ner.render_metrics).
+workers = int(os.environ.get('WORKERS', 4))
+# Sync workers are killed after `timeout` seconds, also while streaming
+# an answer, keep it above ner.BATCH_MAX_SECONDS and the deadlines used.
+timeout = 100
+preload_app = True
+
+
+def on_starting(server):
+    import ner
+    ner.preload()
+
+
+def post_worker_init(worker):
+    # Warm up every worker before it reports ready on /readyz.
+    import ner
+    ner.start_warm_up()
@@ -75,45 +75,188 @@ This will run the doctest, if everything works, and external services are up,
 
     $ gunicorn -w 10 web:application -b :8099
 
+Or, loading the models once, and sharing them between the workers:
+
+    $ WORKERS=10 gunicorn -c gunicorn.conf.py ner:application
+
 Afther this the service can be envoked like this:
 
     $ curl -s localhost:8099/?text="This is a test by Willem Jan."
 
-If you expect to process a lot:
+There is also an asyncio version of the web-service (GET / only),
+where the Stanford and Spotlight calls don't need a thread each:
+
+    $ uvicorn ner:asgi_application --port 8099
+
+Many texts or urls can be sent at once, as a JSON array or as NDJSON,
+results are streamed back as NDJSON in order of completion:
 
-    # echo 1 > /proc/sys/ipv4/tcp_tw_recycle
+    $ curl -s localhost:8099/batch --data-binary @- <<EOF
+    {"id": 1, "text": "This is a test by Willem Jan."}
+    {"id": 2, "url": "http://resolver.kb.nl/resolve?urn=...", "context": 3}
+    EOF
 
-Else there will be no socket's left to process.
+For (nightly) reprocessing of whole collections, skip the web-service,
+and process a directory, tarball or list of urn's directly:
+
+    $ python3 ./ner.py bulk /data/ocr.tar.gz urns.txt -o /data/ner --shards 16
+
+Results are written as NDJSON to /data/ner/part-00000.ndjson etc.
+
+If you expect to process a lot, raise STANFORD_MAX_CONNECTIONS
+(and the number of NERServer threads) rather than tuning the kernel,
+the client reads until the NERServer closes the connection,
+so the TIME_WAIT sockets end up on the server side.
 
 '''
+import argparse
 import ast
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import gc
+import hashlib
 import json
 import lxml.html
+import math
+import multiprocessing
 import operator
+import os
+import queue
+import random
+import re
 import requests
-import spacy
-import telnetlib
+import requests.adapters
+import socket
+import sqlite3
+import sys
+import tarfile
 import threading
 import time
+import urllib.parse
 
 from flask import request, Response, Flask
 from lxml import etree
-from polyglot.text import Text
-
-from flair.models import SequenceTagger
-from flair.data import Sentence
 
 application = Flask(__name__)
 application.debug = True
 
-# Preload Dutch data.
-nlp_spacy = spacy.load('nl')
-nlp_flair = SequenceTagger.load('ner-multi')
+# Engine profiles, pick one per request with ?engines=<profile>,
+# or list the engines to use (?engines=stanford,spacy).
+# Only engines used by at least one profile are loaded.
+ENGINE_PROFILES = {"all": ["flair", "polyglot", "spacy", "spotlight",
+                           "stanford"],
+                   "fast": ["spacy", "spotlight", "stanford"]}
+DEFAULT_PROFILE = "all"
+
+ENABLED_ENGINES = sorted(set(engine
+                             for profile in ENGINE_PROFILES.values()
+                             for engine in profile))
+
+# spaCy pipeline components the NER output does not use,
+# these are not loaded at all.
+SPACY_DISABLE = ["tagger", "parser", "lemmatizer"]
+
+# When to load the Dutch models (and import spacy, flair, torch, polyglot),
+# "lazy": on first use (or an explicit warm_up() call),
+# "eager": when ner.py is imported.
+MODEL_LOADING = "lazy"
+
+# Importing ner.py should take less than this many seconds,
+# checked by test_import_time.
+IMPORT_TIME_BUDGET = 2.0
+
+
+def load_spacy():
+    import spacy
+    return spacy.load('nl', disable=SPACY_DISABLE)
+
+
+def load_flair():
+    from flair.models import SequenceTagger
+    return SequenceTagger.load('ner-multi')
+
+
+def load_polyglot():
+    from polyglot.text import Text
+    return Text
+
+
+MODEL_LOADERS = {"flair": load_flair,
+                 "polyglot": load_polyglot,
+                 "spacy": load_spacy}
+
+MODELS = {}
+MODEL_LOCKS = {engine: threading.Lock() for engine in MODEL_LOADERS}
+
+
+def get_model(engine):
+    '''
+        Return the model of an engine, load it on first use.
+    '''
+    model = MODELS.get(engine)
+    if model is not None:
+        return model
+
+    with MODEL_LOCKS[engine]:
+        if engine not in MODELS:
+            MODELS[engine] = MODEL_LOADERS[engine]()
+        return MODELS[engine]
+
+
+def warm_up(engines=None):
+    '''
+        Load the models of the given engines (default: all enabled) now.
+    '''
+    if engines is None:
+        engines = ENABLED_ENGINES
+
+    for engine in engines:
+        if engine in MODEL_LOADERS:
+            get_model(engine)
+
+
+def model_status():
+    '''
+        Per enabled engine, whether its model is loaded.
+    '''
+    return {engine: engine not in MODEL_LOADERS or engine in MODELS
+            for engine in ENABLED_ENGINES}
+
+
+# Torch threads per gunicorn worker, set after the fork (see preload).
+TORCH_THREADS = 1
+
+# Before a worker reports ready (/readyz), WARMUP_TEXT is run through
+# every enabled engine, waiting at most WARMUP_TIMEOUT seconds per engine.
+WARMUP_TEXT = ("Deze iets langere test bevat de naam Albert Einstein, "
+               "die in 1933 vanuit Berlijn naar Amerika vertrok.")
+WARMUP_TIMEOUT = 300
+
+# A failed warm-up is started again by /readyz, WARMUP_RETRY_BACKOFF
+# seconds after the failure, doubling with every failure up to
+# WARMUP_RETRY_MAX_BACKOFF seconds.
+WARMUP_RETRY_BACKOFF = 5
+WARMUP_RETRY_MAX_BACKOFF = 300
+
+# If True, /readyz also needs every Stanford/Spotlight backend
+# to be reachable, else it only reports on them.
+READY_REQUIRES_BACKENDS = False
+
+if MODEL_LOADING == "eager":
+    warm_up()
 
 # Will be used in web-service and doctest.
 EXAMPLE_URL = "http://resolver.kb.nl/resolve?"
 EXAMPLE_URL += "urn=ddd:010381561:mpeg21:a0049:ocr"
 
+# Used to turn bare urn's (bulk mode) into urls.
+RESOLVER_URL = "http://resolver.kb.nl/resolve?urn="
+
 # Baseurl for Stanford standalone NER setup.
 # https://nlp.stanford.edu/software/crf-faq.shtml#cc
 # (Use inlineXML)
@@ -126,11 +269,205 @@ SPOTLIGHT_HOST = "localhost"
 SPOTLIGHT_PORT = "9091"
 SPOTLIGHT_PATH = "/rest/annotate/"
 
+# Run several Stanford/Spotlight servers by listing them here, calls go to
+# the healthy backend with the least outstanding requests.
+STANFORD_BACKENDS = [(STANFORD_HOST, STANFORD_PORT)]
+SPOTLIGHT_BACKENDS = [(SPOTLIGHT_HOST, SPOTLIGHT_PORT)]
+
+# A backend is ejected after EJECT_FAILURES consecutive failures,
+# and checked every HEALTH_CHECK_INTERVAL seconds until it accepts
+# connections again.
+EJECT_FAILURES = 3
+HEALTH_CHECK_INTERVAL = 5
+
+# Minimal confidence for Spotlight annotations.
+SPOTLIGHT_CONFIDENCE = '0.9'
+
 # Timeout for external NER's (stanford, spotlight)
 TIMEOUT = 1000
 
+# Deadline in seconds for one call to an external NER, including retries.
+CALL_DEADLINE = 60
+
+# Time budget in seconds per request, can be lowered (up to MAX_DEADLINE
+# raised) per request with ?deadline=. Engines that have not finished
+# in time are left out, and listed under "missing" in the response.
+# Keep DEFAULT_DEADLINE below the gunicorn timeout (-t).
+DEFAULT_DEADLINE = 90
+MAX_DEADLINE = 600
+
+# The Flask application runs in gunicorn sync workers, which are killed
+# after the gunicorn timeout, so ?deadline= on GET / is capped to this.
+WSGI_MAX_DEADLINE = 90
+
+# Failed calls are retried at most RETRY_MAX times, waiting RETRY_BACKOFF
+# seconds before the first retry, doubling up to RETRY_BACKOFF_MAX.
+RETRY_MAX = 4
+RETRY_BACKOFF = 0.05
+RETRY_BACKOFF_MAX = 2.0
+
+# Maximum number of simultaneous connections per Stanford NERServer.
+STANFORD_MAX_CONNECTIONS = 16
+
+# Maximum number of kept-alive connections per Spotlight server.
+SPOTLIGHT_MAX_CONNECTIONS = 16
+
+# Number of long-lived worker threads per engine,
+# "batch" is the pool that runs the items of /batch calls.
+POOL_SIZE = {"flair": 1,
+             "polyglot": 2,
+             "spacy": 2,
+             "spotlight": 8,
+             "stanford": 8,
+             "batch": 16}
+
+# Number of jobs per engine that may wait for a free worker,
+# once the queue is full, new submissions block until a slot frees up.
+POOL_QUEUE_SIZE = {"flair": 32,
+                   "polyglot": 32,
+                   "spacy": 32,
+                   "spotlight": 64,
+                   "stanford": 64,
+                   "batch": 64}
+
+# Items of one /batch call that are processed at the same time,
+# and the maximum number of items per call.
+# All items share the "batch" pool (see POOL_SIZE).
+BATCH_WORKERS = 16
+BATCH_MAX_ITEMS = 10000
+
+# Time limit of one /batch call, it must stay below the gunicorn worker
+# timeout (gunicorn.conf.py), which kills a sync worker in the middle of
+# a streamed answer. Item deadlines are capped to it, and items that did
+# not start in time are answered with an error, to be sent again.
+BATCH_MAX_SECONDS = 80
+
+# Circuit breaker per engine, once at least BREAKER_MIN_CALLS of the last
+# BREAKER_WINDOW calls were made, and BREAKER_FAILURE_RATE of them failed,
+# the engine is skipped for BREAKER_COOLDOWN seconds. After that
+# BREAKER_PROBES calls are let through, if they succeed the engine is used
+# again, else it's skipped for another cool-down period.
+BREAKER_WINDOW = 20
+BREAKER_MIN_CALLS = 5
+BREAKER_FAILURE_RATE = 0.5
+BREAKER_COOLDOWN = 30
+BREAKER_PROBES = 1
+
+# Cache for the raw output of each engine per part, keyed on a hash of the
+# text, engine, MODEL_VERSIONS and Spotlight confidence. Integration and
+# context are not cached, they are cheap to redo. There is an in-memory LRU
+# per worker of at most CACHE_MEMORY_BYTES (0 disables it), and an
+# optional on-disk SQLite cache (CACHE_DB), shared by all gunicorn
+# workers on the host, of at most CACHE_DB_BYTES.
+CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+CACHE_DB = None
+CACHE_DB_BYTES = 1024 * 1024 * 1024
+
+# Model versions used by the engines, bump these when a model is
+# updated, so cached results of the old model are no longer used.
+MODEL_VERSIONS = {"flair": "ner-multi",
+                  "polyglot": "ner2.nl",
+                  "spacy": "nl",
+                  "spotlight": "nl-2016-10",
+                  "stanford": "dutch.crf.gz"}
+
+# Histogram buckets for /metrics, engine and request latency in seconds,
+# and request size in characters of text.
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                           1, 2.5, 5, 10, 30, 60)
+METRICS_SIZE_BUCKETS = (100, 300, 1000, 3000, 10000, 30000, 100000)
+
+# Tracing, off unless TRACE_FILE or TRACE_URL is set. A traced request has
+# spans for the fetch and parse of the OCR, every engine run per part
+# (with its queue wait and execution time), the integration and context
+# of every part, and the JSON encoding of the answer. TRACE_FILE gets one
+# JSON span per line, TRACE_URL gets the spans of every request POSTed in
+# the OTLP/HTTP JSON format, e.g. "http://localhost:4318/v1/traces".
+# TRACE_SAMPLE is the fraction of requests traced.
+TRACE_FILE = None
+TRACE_URL = None
+TRACE_SAMPLE = 1.0
+
+# Profiling of single requests with /?profile=1, off by default, since
+# anyone can trigger it. While the engines run, the request thread and the
+# engine pool threads are sampled every PROFILE_INTERVAL seconds, and the
+# answer gets the samples as folded stacks (the input of flamegraph.pl or
+# speedscope), they're also stored in PROFILE_DIR if it's set.
+# One request at a time is profiled. Engines in PROCESS_ENGINES run in
+# other processes, they are not sampled.
+PROFILING_ENABLED = False
+PROFILE_INTERVAL = 0.005
+PROFILE_DIR = None
+
+# Engines that run in dedicated worker processes instead of threads,
+# so CPU-bound inference is not serialized by the GIL, for example:
+# PROCESS_ENGINES = ["flair", "spacy"]
+# These use POOL_SIZE processes, each holding its own copy of the model.
+PROCESS_ENGINES = []
+PROCESS_START_METHOD = "spawn"
+
+# Torch threads per Flair worker process.
+PROCESS_TORCH_THREADS = 1
+
+# Cross-request batching, parts from all requests in flight are collected
+# until BATCH_SIZE parts are waiting, or the oldest part has waited
+# BATCH_LATENCY seconds, the batch is then run as one job on the engine pool.
+# Engines not listed here (or with a batch size of 1) are not batched.
+BATCH_SIZE = {"flair": 32, "spacy": 64}
+BATCH_LATENCY = {"flair": 0.05, "spacy": 0.02}
+
+# Number of parts per batched engine that may wait to be put in a batch,
+# once full, new parts wait for room until their deadline.
+BATCH_QUEUE_SIZE = {"flair": 256, "spacy": 512}
+
+# mini_batch_size passed to SequenceTagger.predict.
+FLAIR_MINI_BATCH_SIZE = 32
+
+# batch_size and n_process passed to spaCy's nlp.pipe.
+SPACY_PIPE_BATCH_SIZE = 64
+SPACY_N_PROCESS = 1
+
+
+class TokenIndex(object):
+    '''
+        Offsets of the whitespace separated tokens of a text, to find the
+        context tokens left and right of a position by bisection, instead
+        of splitting the whole text for every NE. Gives the same tokens as
+        text[:pos].split()[-context:] and text[end:].split()[:context].
+
+        >>> text = "Deze test bevat de naam Albert Einstein, en meer."
+        >>> index = TokenIndex(text)
+        >>> index.left(24, 2), index.right(39, 2)
+        ('de naam', ', en')
+        >>> all(index.left(pos, n) == " ".join(text[:pos].split()[-n:]) and
+        ...     index.right(pos, n) == " ".join(text[pos:].split()[:n])
+        ...     for pos in range(len(text) + 1) for n in range(-3, 4))
+        True
+    '''
+
+    def __init__(self, text):
+        self.text = text
+        self.starts = []
+        self.ends = []
 
-def context(text_org, ne, pos, context=5):
+        for match in re.finditer(r'\S+', text):
+            self.starts.append(match.start())
+            self.ends.append(match.end())
+
+    def left(self, pos, context):
+        # Tokens starting before pos, the last one may be cut off at pos.
+        count = bisect.bisect_left(self.starts, pos)
+        return " ".join(self.text[self.starts[i]:min(self.ends[i], pos)]
+                        for i in range(count)[-context:])
+
+    def right(self, pos, context):
+        # Tokens ending after pos, the first one may start before it.
+        first = bisect.bisect_right(self.ends, pos)
+        return " ".join(self.text[max(self.starts[i], pos):self.ends[i]]
+                        for i in range(first, len(self.ends))[:context])
+
+
+def context(text_org, ne, pos, context=5, index=None):
     '''
         Return the context of an NE, based on abs-pos,
         if there are 'context-tokens' in the way,
@@ -138,14 +475,22 @@ def context(text_org, ne, pos, context=5):
 
         Current defined context-tokens:
         ”„!,'\",`<>?-+"
+
+        index is an optional TokenIndex of text_org,
+        to share between the NE's of a text.
     '''
     CONTEXT_TOKENS = "”„!,'\",`<>?-+\\"
 
-    leftof = text_org[:pos].strip()
-    l_context = " ".join(leftof.split()[-context:])
+    if index is not None and isinstance(pos, int) and \
+            0 <= pos <= len(text_org):
+        l_context = index.left(pos, context)
+        r_context = index.right(pos + len(ne), context)
+    else:
+        leftof = text_org[:pos].strip()
+        l_context = " ".join(leftof.split()[-context:])
 
-    rightof = text_org[pos + len(ne):].strip()
-    r_context = " ".join(rightof.split()[:context])
+        rightof = text_org[pos + len(ne):].strip()
+        r_context = " ".join(rightof.split()[:context])
 
     ne_context = ne
 
@@ -183,6 +528,384 @@ def translate(input_str):
     return input_str
 
 
+class DeadlineExceeded(Exception):
+    pass
+
+
+def call_with_retry(fn, deadline, retries=None):
+    '''
+        Call fn(deadline) until it succeeds, retrying failures with
+        exponential backoff, at most `retries` times and never past
+        the deadline (a time.time() timestamp).
+        The last error is raised once retrying stops.
+
+        >>> calls = []
+        >>> def flaky(deadline):
+        ...     calls.append(1)
+        ...     if len(calls) < 3:
+        ...         raise IOError('refused')
+        ...     return 'ok'
+        >>> call_with_retry(flaky, time.time() + 10, retries=3)
+        'ok'
+        >>> len(calls)
+        3
+    '''
+    if retries is None:
+        retries = RETRY_MAX
+
+    attempt = 0
+    while True:
+        if time.time() >= deadline:
+            raise DeadlineExceeded()
+
+        try:
+            return fn(deadline)
+        except Exception:
+            attempt += 1
+            delay = min(RETRY_BACKOFF * 2 ** (attempt - 1), RETRY_BACKOFF_MAX)
+            if attempt > retries or time.time() + delay >= deadline:
+                raise
+            time.sleep(delay)
+
+
+class StanfordClient(object):
+    '''
+        Client for the Stanford NERServer socket protocol.
+
+        The NERServer tags one line of text per connection, and closes
+        the connection once the answer is written, so connections can't be
+        reused. Instead the number of simultaneous connections is bounded
+        by max_connections, and the answer is read until the server closes,
+        which leaves the TIME_WAIT state on the server side.
+    '''
+
+    def __init__(self, backends, max_connections=16):
+        self.backends = backends
+        self._slots = threading.BoundedSemaphore(
+                max_connections * len(backends.backends))
+
+    def tag(self, text, deadline, caller_deadline=None):
+        '''
+            Return the inlineXML answer for text,
+            raise DeadlineExceeded if there is no answer before deadline.
+            Only running out of time before caller_deadline, the deadline
+            of the request, counts against the backend.
+        '''
+        if not self._slots.acquire(timeout=max(deadline - time.time(), 0)):
+            raise DeadlineExceeded()
+
+        try:
+            return call_with_retry(
+                    lambda deadline: self._tag(text, deadline,
+                                               caller_deadline),
+                    deadline)
+        finally:
+            self._slots.release()
+
+    def _tag(self, text, deadline, caller_deadline=None):
+        with self.backends.use(caller_deadline) as backend:
+            return self._tag_backend(backend, text, deadline)
+
+    def _tag_backend(self, backend, text, deadline):
+        conn = socket.create_connection((backend.host, backend.port),
+                                        timeout=remaining(deadline))
+        try:
+            conn.sendall(text.encode('utf-8') + b'\n')
+
+            chunks = []
+            while True:
+                conn.settimeout(remaining(deadline))
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            conn.close()
+
+        return b''.join(chunks).decode('utf-8')
+
+
+def call_deadline(start_time, deadline=None):
+    '''
+        Deadline for a call to an external NER,
+        never later than the deadline of the request.
+    '''
+    if deadline is None:
+        return start_time + min(CALL_DEADLINE, TIMEOUT)
+    return min(start_time + min(CALL_DEADLINE, TIMEOUT), deadline)
+
+
+def remaining(deadline):
+    '''
+        Seconds left until deadline, raise DeadlineExceeded if none.
+    '''
+    left = deadline - time.time()
+    if left <= 0:
+        raise DeadlineExceeded()
+    return left
+
+
+class Backend(object):
+    '''
+        One Stanford or Spotlight server.
+    '''
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = int(port)
+        self.outstanding = 0
+        self.failures = 0
+        self.healthy = True
+
+    def __repr__(self):
+        return '%s:%s' % (self.host, self.port)
+
+    def check(self, timeout=1):
+        '''
+            True if the backend accepts connections.
+        '''
+        try:
+            socket.create_connection((self.host, self.port),
+                                     timeout=timeout).close()
+            return True
+        except (OSError, ValueError):
+            return False
+
+
+class BackendGroup(object):
+    '''
+        Least outstanding requests balancing over a list of backends.
+
+        A backend is ejected after eject_failures consecutive failures,
+        and put back once a health check reaches it again. If every
+        backend is ejected, all of them are used, so a recovered
+        backend is noticed without waiting for the health check.
+
+        >>> group = BackendGroup('test', [('localhost', 1), ('localhost', 2)])
+        >>> with group.use() as a:
+        ...     with group.use() as b:
+        ...         sorted([a.port, b.port])
+        [1, 2]
+    '''
+
+    def __init__(self, name, backends, eject_failures=3, interval=5):
+        self.name = name
+        self.backends = [Backend(host, port) for host, port in backends]
+        self.eject_failures = eject_failures
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._checker = None
+        self._next = 0
+
+    def acquire(self):
+        with self._lock:
+            candidates = [b for b in self.backends if b.healthy]
+            if not candidates:
+                candidates = self.backends
+
+            # Rotate the start, so ties are spread over the backends.
+            self._next = (self._next + 1) % len(candidates)
+            candidates = candidates[self._next:] + candidates[:self._next]
+
+            backend = min(candidates, key=lambda b: b.outstanding)
+            backend.outstanding += 1
+            return backend
+
+    def release(self, backend, ok=True):
+        '''
+            Give back a backend, ok is None if the call was cancelled,
+            which counts neither as a success nor as a failure.
+        '''
+        with self._lock:
+            backend.outstanding -= 1
+
+            if ok is None:
+                return
+
+            if ok:
+                backend.failures = 0
+                backend.healthy = True
+                return
+
+            backend.failures += 1
+            if backend.healthy and backend.failures >= self.eject_failures:
+                backend.healthy = False
+                self._start_checker()
+
+    @contextlib.contextmanager
+    def use(self, caller_deadline=None):
+        '''
+            Acquire a backend, failures inside the block count
+            against the backend. The backend is also given back if the
+            block is left otherwise, like a cancelled coroutine.
+
+            Running out of time doesn't count, if it's the deadline
+            the caller picked (caller_deadline) that has passed:
+
+            >>> group = BackendGroup('test', [('localhost', 1)])
+            >>> with group.use(time.time() - 1) as backend:
+            ...     raise socket.timeout()
+            Traceback (most recent call last):
+            ...
+            TimeoutError
+            >>> backend.failures
+            0
+        '''
+        backend = self.acquire()
+        ok = None
+        try:
+            yield backend
+            ok = True
+        except DeadlineExceeded:
+            raise
+        except Exception:
+            if caller_deadline is None or time.time() < caller_deadline:
+                ok = False
+            raise
+        finally:
+            self.release(backend, ok)
+
+    def _start_checker(self):
+        if self._checker is None or not self._checker.is_alive():
+            self._checker = threading.Thread(target=self._check_loop,
+                                             name=self.name + '-health',
+                                             daemon=True)
+            self._checker.start()
+
+    def _check_loop(self):
+        while True:
+            time.sleep(self.interval)
+
+            with self._lock:
+                ejected = [b for b in self.backends if not b.healthy]
+            if not ejected:
+                return
+
+            for backend in ejected:
+                if backend.check():
+                    with self._lock:
+                        backend.failures = 0
+                        backend.healthy = True
+
+    def status(self):
+        with self._lock:
+            return [{"backend": repr(b),
+                     "healthy": b.healthy,
+                     "outstanding": b.outstanding,
+                     "failures": b.failures} for b in self.backends]
+
+
+BACKENDS = {}
+BACKENDS_LOCK = threading.Lock()
+
+
+def get_backends(engine):
+    '''
+        Return the BackendGroup for stanford or spotlight.
+    '''
+    with BACKENDS_LOCK:
+        if engine not in BACKENDS:
+            backends = {"stanford": STANFORD_BACKENDS,
+                        "spotlight": SPOTLIGHT_BACKENDS}[engine]
+            BACKENDS[engine] = BackendGroup(engine,
+                                            backends,
+                                            EJECT_FAILURES,
+                                            HEALTH_CHECK_INTERVAL)
+        return BACKENDS[engine]
+
+
+STANFORD_CLIENT = None
+STANFORD_CLIENT_LOCK = threading.Lock()
+
+
+def get_stanford_client():
+    global STANFORD_CLIENT
+
+    with STANFORD_CLIENT_LOCK:
+        if STANFORD_CLIENT is None:
+            STANFORD_CLIENT = StanfordClient(get_backends("stanford"),
+                                             STANFORD_MAX_CONNECTIONS)
+        return STANFORD_CLIENT
+
+
+class SpotlightClient(object):
+    '''
+        Client for the Spotlight /rest/annotate service.
+
+        All calls share one requests session, so connections to the
+        Spotlight servers are kept alive and reused. Texts are POSTed
+        as form data, so long OCR texts don't run into url limits.
+    '''
+
+    def __init__(self, backends, max_connections=16):
+        self.backends = backends
+
+        adapter = requests.adapters.HTTPAdapter(
+                pool_connections=len(backends.backends),
+                pool_maxsize=max_connections)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def annotate(self, text, confidence, deadline, caller_deadline=None):
+        '''
+            Return the surface forms and offsets Spotlight found in text,
+            like StanfordClient.tag().
+        '''
+        return call_with_retry(
+                lambda deadline: self._annotate(text, confidence, deadline,
+                                                caller_deadline),
+                deadline)
+
+    def _annotate(self, text, confidence, deadline, caller_deadline=None):
+        with self.backends.use(caller_deadline) as backend:
+            url = 'http://%s:%s%s' % (backend.host,
+                                      backend.port,
+                                      SPOTLIGHT_PATH)
+            response = self.session.post(
+                    url,
+                    data={'text': text,
+                          'confidence': str(confidence)},
+                    headers={"Accept": "application/json"},
+                    timeout=remaining(deadline))
+            response.raise_for_status()
+            data = response.json()
+
+        return spotlight_result(data)
+
+
+def spotlight_result(data):
+    '''
+        Read the surface forms and offsets from a Spotlight answer.
+
+        >>> spotlight_result({"Resources": [{"@surfaceForm": "Nixon",
+        ...                                  "@offset": "8",
+        ...                                  "@URI": "..."}]})
+        [{'ne': 'Nixon', 'pos': 8, 'type': 'other'}]
+    '''
+    result = []
+    for item in (data or {}).get('Resources') or []:
+        result.append({"ne": item.get('@surfaceForm'),
+                       "pos": int(item.get('@offset')),
+                       "type": "other"})
+    return result
+
+
+SPOTLIGHT_CLIENT = None
+SPOTLIGHT_CLIENT_LOCK = threading.Lock()
+
+
+def get_spotlight_client():
+    global SPOTLIGHT_CLIENT
+
+    with SPOTLIGHT_CLIENT_LOCK:
+        if SPOTLIGHT_CLIENT is None:
+            SPOTLIGHT_CLIENT = SpotlightClient(get_backends("spotlight"),
+                                               SPOTLIGHT_MAX_CONNECTIONS)
+        return SPOTLIGHT_CLIENT
+
+
 class Stanford(threading.Thread):
     '''
         Wrapper for Stanford.
@@ -202,63 +925,28 @@ class Stanford(threading.Thread):
     result = {}
 
     def __init__(self, group=None, target=None,
-                 name=None, parsed_text={}):
+                 name=None, parsed_text={}, deadline=None):
 
         threading.Thread.__init__(self, group=group, target=target, name=name)
         self.parsed_text = parsed_text
+        self.deadline = deadline
 
     def run(self):
         start_time = time.time()
 
         text = self.parsed_text.replace('\n', ' ')
 
-        done = False
-        retry = 0
-        max_retry = 10
-
-        while not done and retry < max_retry:
-            try:
-                conn = telnetlib.Telnet(host=STANFORD_HOST,
-                                        port=STANFORD_PORT,
-                                        timeout=TIMEOUT)
-                done = True
-            except Exception:
-                retry += 1
-
-        if not done:
+        try:
+            raw_data = get_stanford_client().tag(
+                    text,
+                    call_deadline(start_time, self.deadline),
+                    self.deadline)
+        except Exception:
             self.result = {"stanford": []}
             return
 
-        text = text.encode('utf-8') + b'\n'
-        conn.write(text)
-        raw_data = conn.read_all().decode('utf-8')
-        conn.close()
-
-        data = etree.fromstring('<root>' + \
-                                raw_data.replace('<', '|') + \
-                                '</root>')
-
-        result = []
-
-        p_tag = ''
-        for item in data.iter():
-            if not item.tag == 'root':
-                tag = item.tag.split('-')[1]
-                if item.tag.split('-')[0] == 'I' and p_tag == tag:
-                    result[-1]["ne"] = result[-1]["ne"] + ' ' + item.text
-                else:
-                    result.append({"ne": item.text,
-                                   "type": translate(item.tag.split('-')[1])})
-                    p_tag = tag
-
-        offset = 0
-        for i, ne in enumerate(result):
-            ne = ne["ne"]
-            pos = self.parsed_text[offset:].find(ne)
-            result[i]["pos"] = pos + offset
-            offset += pos + len(ne)
-
-        self.result = {"stanford": result,
+        self.result = {"stanford": stanford_result(self.parsed_text,
+                                                   raw_data),
                        "timing_stanford": time.time() - start_time}
 
     def join(self):
@@ -266,6 +954,60 @@ class Stanford(threading.Thread):
         return self.result
 
 
+def stanford_result(parsed_text, raw_data):
+    '''
+        Turn the inlineXML answer of the NERServer
+        into a list of entities with positions.
+
+        Only the entity tags are markup, the rest of the answer is the
+        OCR text as-is, which can hold any '<' or '&'. An I- token
+        continues the entity before it, if only whitespace separates them:
+
+        >>> stanford_result("Prof. Albert Einstein <Leiden> & Co.",
+        ...     "Prof. <I-PER>Albert</I-PER> <I-PER>Einstein</I-PER> "
+        ...     "<<I-LOC>Leiden</I-LOC>> & Co.")
+        ... # doctest: +NORMALIZE_WHITESPACE
+        [{'ne': 'Albert Einstein', 'type': 'person', 'pos': 6},
+         {'ne': 'Leiden', 'type': 'location', 'pos': 23}]
+        >>> stanford_result("Wilhelmina en Hendrik",
+        ...     "<I-PER>Wilhelmina</I-PER> en <I-PER>Hendrik</I-PER>")
+        ... # doctest: +NORMALIZE_WHITESPACE
+        [{'ne': 'Wilhelmina', 'type': 'person', 'pos': 0},
+         {'ne': 'Hendrik', 'type': 'person', 'pos': 14}]
+    '''
+    markup = ''.join(
+            part if i % 2 else part.replace('&', '&amp;').replace('<', '&lt;')
+            for i, part in enumerate(re.split(r'(</?[A-Z]+-[A-Z]+>)',
+                                              raw_data)))
+
+    data = etree.fromstring('<root>' + markup + '</root>')
+
+    result = []
+
+    p_tag = ''
+    p_tail = ''
+    for item in data.iter():
+        if not item.tag == 'root':
+            tag = item.tag.split('-')[1]
+            if item.tag.split('-')[0] == 'I' and p_tag == tag and \
+                    not (p_tail or '').strip():
+                result[-1]["ne"] = result[-1]["ne"] + ' ' + item.text
+            else:
+                result.append({"ne": item.text,
+                               "type": translate(item.tag.split('-')[1])})
+                p_tag = tag
+            p_tail = item.tail
+
+    offset = 0
+    for i, ne in enumerate(result):
+        ne = ne["ne"]
+        pos = parsed_text[offset:].find(ne)
+        result[i]["pos"] = pos + offset
+        offset += pos + len(ne)
+
+    return result
+
+
 class Flair(threading.Thread):
     '''
         Wrapper for Flair.
@@ -290,32 +1032,63 @@ class Flair(threading.Thread):
         self.parsed_text = parsed_text
 
     def run(self):
-        start_time = time.time()
-        sentence = [Sentence(self.parsed_text, use_tokenizer=False)]
-        tagged = nlp_flair.predict(sentence)
+        self.result = flair_batch([self.parsed_text])[0]
+
+    def join(self):
+        threading.Thread.join(self)
+        return self.result
+
+
+def batch_timing(timing, texts):
+    '''
+        Split the time of a batch over its texts, by their length,
+        so the timing of a text is its share of the work, and the
+        timings of a batch add up to the time of the batch.
+
+        >>> batch_timing(1.0, ["abc", "a"])
+        [0.75, 0.25]
+        >>> batch_timing(1.0, ["", ""])
+        [0.5, 0.5]
+    '''
+    total = sum(len(text) for text in texts)
+    if not total:
+        return [timing / len(texts) for text in texts]
+    return [timing * len(text) / total for text in texts]
+
+
+def flair_batch(texts):
+    '''
+        Tag a batch of texts with one SequenceTagger.predict call,
+        returns one Flair result per text, with its share of the
+        batch time (see batch_timing()) as timing_flair.
+    '''
+    start_time = time.time()
 
-        tagged_items = [
-                s.to_dict(tag_type='ner').get('entities') for s in tagged
-                ]
+    nlp_flair = get_model("flair")
+    from flair.data import Sentence
 
+    sentences = [Sentence(text, use_tokenizer=False) for text in texts]
+    nlp_flair.predict(sentences, mini_batch_size=FLAIR_MINI_BATCH_SIZE)
+
+    timings = batch_timing(time.time() - start_time, texts)
+
+    results = []
+    for sentence, timing in zip(sentences, timings):
         result = []
 
-        for item in tagged_items:
-            for i in item:
-                if not i:
-                    continue
-                result.append({
-                    "ne": i.get('text'),
-                    "pos": i.get('start_pos'),
-                    "type": translate(i.get('type'))
-                })
+        for i in sentence.to_dict(tag_type='ner').get('entities'):
+            if not i:
+                continue
+            result.append({
+                "ne": i.get('text'),
+                "pos": i.get('start_pos'),
+                "type": translate(i.get('type'))
+            })
 
-        self.result = {"flair": self.result,
-                       "timing_flair": time.time() - start_time}
+        results.append({"flair": result,
+                        "timing_flair": timing})
 
-    def join(self):
-        threading.Thread.join(self)
-        return self.result
+    return results
 
 
 class Polyglot(threading.Thread):
@@ -345,6 +1118,7 @@ class Polyglot(threading.Thread):
         buffer_all = []
 
         try:
+            Text = get_model("polyglot")
             text = Text(self.parsed_text, hint_language_code='nl')
 
             for sent in text.sentences:
@@ -411,29 +1185,65 @@ class Spacy(threading.Thread):
         self.parsed_text = parsed_text
 
     def run(self):
-        start_time = time.time()
+        self.result = spacy_batch([self.parsed_text])[0]
+
+    def join(self):
+        threading.Thread.join(self)
+        return self.result
+
+
+def spacy_result(text, doc):
+    '''
+        Turn a spaCy doc into a list of entities with positions.
+    '''
+    result = []
+    try:
+        for ent in doc.ents:
+            result.append({"ne": ent.text, "type": translate(ent.label_)})
+
+        offset = 0
+        for i, ne in enumerate(result):
+            ne = ne["ne"]
+            pos = text[offset:].find(ne)
+            result[i]["pos"] = pos + offset
+            offset += pos + len(ne)
+    except Exception:
         result = []
-        try:
-            doc = nlp_spacy(self.parsed_text)
 
-            for ent in doc.ents:
-                result.append({"ne": ent.text, "type": translate(ent.label_)})
+    return result
 
-            offset = 0
-            for i, ne in enumerate(result):
-                ne = ne["ne"]
-                pos = self.parsed_text[offset:].find(ne)
-                result[i]["pos"] = pos + offset
-                offset += pos + len(ne)
-        except Exception:
-            pass
 
-        self.result = {"spacy": result,
-                       "timing_spacy": time.time() - start_time}
+def spacy_batch(texts):
+    '''
+        Run a batch of texts through nlp.pipe,
+        returns one Spacy result per text, with its share of the
+        batch time (see batch_timing()) as timing_spacy.
+    '''
+    start_time = time.time()
 
-    def join(self):
-        threading.Thread.join(self)
-        return self.result
+    kwargs = {"batch_size": SPACY_PIPE_BATCH_SIZE}
+    if SPACY_N_PROCESS > 1:
+        kwargs["n_process"] = SPACY_N_PROCESS
+
+    nlp_spacy = get_model("spacy")
+
+    try:
+        docs = list(nlp_spacy.pipe(texts, **kwargs))
+        entities = [spacy_result(text, doc) for text, doc in zip(texts, docs)]
+    except Exception:
+        # One bad text should not empty the whole batch.
+        entities = []
+        for text in texts:
+            try:
+                entities.append(spacy_result(text, nlp_spacy(text)))
+            except Exception:
+                entities.append([])
+
+    timings = batch_timing(time.time() - start_time, texts)
+
+    return [{"spacy": result,
+             "timing_spacy": timing}
+            for result, timing in zip(entities, timings)]
 
 
 class Spotlight(threading.Thread):
@@ -452,309 +1262,2639 @@ class Spotlight(threading.Thread):
     '''
 
     def __init__(self, group=None, target=None,
-                 name=None, parsed_text={}, confidence='0.9'):
+                 name=None, parsed_text={},
+                 confidence=SPOTLIGHT_CONFIDENCE, deadline=None):
 
         threading.Thread.__init__(self, group=group, target=target, name=name)
         self.parsed_text = parsed_text
         self.confidence = confidence
+        self.deadline = deadline
 
     def run(self):
         start_time = time.time()
 
-        data = {'text': self.parsed_text,
-                'confidence': str(self.confidence)}
-
-        url = 'http://'
-        url += SPOTLIGHT_HOST
-        url += ':' + SPOTLIGHT_PORT
-        url += SPOTLIGHT_PATH
-
-        header = {"Accept": "application/json"}
-
-        done = False
-        retry = 0
-        max_retry = 10
+        try:
+            result = get_spotlight_client().annotate(
+                    self.parsed_text,
+                    self.confidence,
+                    call_deadline(start_time, self.deadline),
+                    self.deadline)
+        except Exception:
+            self.result = {"spotlight": []}
+            return
 
-        while not done and retry < max_retry:
-            try:
-                response = requests.get(url,
-                                        params=data,
-                                        headers=header,
-                                        timeout=TIMEOUT)
-
-                data = response.json()
-                result = []
-
-                if data and data.get('Resources'):
-                    for item in data.get('Resources'):
-                        ne = {}
-                        ne["ne"] = item.get('@surfaceForm')
-                        ne["pos"] = int(item.get('@offset'))
-                        ne["type"] = "other"
-                        result.append(ne)
-
-                self.result = {"spotlight": result,
-                               "timing_spotlight": time.time() - start_time}
-                done = True
-            except Exception:
-                self.result = {"spotlight": []}
-                retry += 1
+        self.result = {"spotlight": result,
+                       "timing_spotlight": time.time() - start_time}
 
     def join(self):
         threading.Thread.join(self)
         return self.result
 
 
-def intergrate_results(result, source, source_text, context_len):
-    new_result = {}
-    res = []
+ENGINES = {"flair": Flair,
+           "polyglot": Polyglot,
+           "spacy": Spacy,
+           "spotlight": Spotlight,
+           "stanford": Stanford}
 
-    for ne in result.get("stanford"):
-        res = {}
-        res["count"] = 1
-        res["ne"] = ne.get("ne")
-        res["ner_src"] = ["stanford"]
-        res["type"] = {ne.get("type"): 1}
-        res["pref_type"] = ne.get("type")
-        new_result[ne.get("pos")] = res
+# Engines that call an external server.
+NETWORK_ENGINES = ["spotlight", "stanford"]
 
-    for ne in result.get("spotlight"):
-        if not ne.get("pos") in res:
-            res = {}
-            res["count"] = 1
-            res["ne"] = ne.get("ne")
-            res["ner_src"] = ["spotlight"]
-            res["type"] = {ne.get("type"): 1}
-            res["pref_type"] = ne.get("type")
-            new_result[ne.get("pos")] = res
+
+class EnginePool(object):
+    '''
+        Long-lived, bounded pool of workers for one engine.
+
+        Jobs wait in a queue until a worker is free, once `queue_size`
+        jobs are waiting, submit() blocks until a slot frees up, or
+        raises DeadlineExceeded if none does before its deadline.
+        With processes=True the workers are separate processes,
+        the submitted function and its arguments must be picklable.
+
+        >>> pool = EnginePool('test', size=1, queue_size=2)
+        >>> pool.submit(sum, [1, 2]).result()
+        3
+        >>> pool.depth()
+        0
+    '''
+
+    def __init__(self, name, size=1, queue_size=16, processes=False):
+        self.name = name
+        self.size = size
+        self.queue_size = queue_size
+        self.processes = processes
+        self.pending = 0
+        self.running = 0
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size + queue_size)
+
+        if processes:
+            ctx = multiprocessing.get_context(PROCESS_START_METHOD)
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=size,
+                    mp_context=ctx,
+                    initializer=init_engine_process,
+                    initargs=(name,))
         else:
-            new_result[ne.get("pos")]["count"] += 1
-            new_result[ne.get("pos")]["ner_src"].append("spotlight")
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=size, thread_name_prefix=name)
 
-            if not ne.get("type") in new_result[ne.get("pos")]["type"]:
-                new_result[ne.get("pos")]["type"][ne.get("type")] = 1
+    def _run(self, fn, args):
+        with self._lock:
+            self.running += 1
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+        self._slots.release()
+
+    def submit(self, fn, *args, deadline=None):
+        if deadline is None:
+            self._slots.acquire()
+        elif not self._slots.acquire(timeout=max(deadline - time.time(), 0)):
+            raise DeadlineExceeded()
+
+        with self._lock:
+            self.pending += 1
+        try:
+            if self.processes:
+                future = self._executor.submit(fn, *args)
             else:
-                new_result[ne.get("pos")]["type"][ne.get("type")] += 1
+                future = self._executor.submit(self._run, fn, args)
+        except Exception:
+            with self._lock:
+                self.pending -= 1
+            self._slots.release()
+            raise
+
+        future.add_done_callback(self._done)
+        return future
+
+    def busy(self):
+        '''
+            Number of workers currently running a job.
+        '''
+        with self._lock:
+            if self.processes:
+                return min(self.pending, self.size)
+            return self.running
+
+    def depth(self):
+        '''
+            Number of jobs waiting for a free worker.
+        '''
+        return self.pending - self.busy()
+
+
+class Batcher(object):
+    '''
+        Collect jobs from all requests in flight, and hand them to
+        dispatch() in batches.
+
+        A batch is flushed once batch_size jobs are waiting, or when
+        the oldest job has waited `latency` seconds. dispatch() gets
+        the list of items and the latest deadline of their jobs, and
+        returns a future holding one result per item.
+
+        Like EnginePool.submit(), submit() blocks once `queue_size` jobs
+        are waiting, or raises DeadlineExceeded if no room frees up
+        before its deadline. Jobs whose deadline has passed by the
+        time their batch is flushed are left out of it.
+
+        >>> pool = EnginePool('test', size=1)
+        >>> b = Batcher('test',
+        ...             lambda texts, deadline: pool.submit(
+        ...                 lambda: [t.upper() for t in texts],
+        ...                 deadline=deadline),
+        ...             batch_size=2, latency=0.01)
+        >>> b.submit('a', deadline=time.time() + 10).result()
+        'A'
+        >>> future = b.submit('b', deadline=time.time() - 1)
+        >>> isinstance(future.exception(), DeadlineExceeded)
+        True
+    '''
 
-    parsers = ["spacy", "polyglot", "flair"]
+    def __init__(self, name, dispatch, batch_size=32, latency=0.05,
+                 queue_size=256):
+        self.name = name
+        self.dispatch = dispatch
+        self.batch_size = batch_size
+        self.latency = latency
 
-    for parser in parsers:
-        if result.get(parser) is None:
-            continue
-        for ne in result.get(parser):
-            if ne.get("pos") in new_result:
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._loop,
+                                        name=name + '-batcher',
+                                        daemon=True)
+        self._thread.start()
 
-                if parser in new_result[ne.get("pos")]["ner_src"]:
-                    continue
+    def submit(self, item, deadline=None):
+        future = concurrent.futures.Future()
+        job = (time.time(), item, future, deadline)
 
-                new_result[ne.get("pos")]["count"] += 1
-                new_result[ne.get("pos")]["ner_src"].append(parser)
+        try:
+            if deadline is None:
+                self._queue.put(job)
+            else:
+                self._queue.put(job, timeout=max(deadline - time.time(), 0))
+        except queue.Full:
+            raise DeadlineExceeded()
+
+        return future
+
+    def depth(self):
+        '''
+            Number of jobs waiting to be put in a batch.
+        '''
+        return self._queue.qsize()
+
+    def _loop(self):
+        while True:
+            job = self._queue.get()
+            batch = [job]
+            deadline = job[0] + self.latency
+
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._flush(batch)
+
+    def _flush(self, jobs):
+        now = time.time()
+        batch = []
+        deadlines = []
+        for _, item, future, deadline in jobs:
+            if not future.set_running_or_notify_cancel():
+                continue
+            if deadline is not None and deadline <= now:
+                future.set_exception(DeadlineExceeded())
+                continue
+            batch.append((item, future))
+            deadlines.append(deadline)
+
+        if not batch:
+            return
+
+        # Wait for room on the engine pool as long as any job still can.
+        deadline = None if None in deadlines else max(deadlines)
+
+        def scatter(batch_future):
+            try:
+                results = batch_future.result()
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                return
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+        try:
+            self.dispatch([item for item, _ in batch],
+                          deadline).add_done_callback(scatter)
+        except Exception as error:
+            for _, future in batch:
+                future.set_exception(error)
+
+
+class CircuitBreaker(object):
+    '''
+        Circuit breaker, with closed, open and half_open states.
+
+        >>> breaker = CircuitBreaker('test', window=4, min_calls=2,
+        ...                          failure_rate=0.5, cooldown=60)
+        >>> breaker.record(False)
+        >>> breaker.record(False)
+        >>> breaker.state, breaker.allow()
+        ('open', False)
+        >>> breaker.opened_at -= 60
+        >>> breaker.allow(), breaker.state, breaker.allow()
+        (True, 'half_open', False)
+        >>> breaker.record(True)
+        >>> breaker.state, breaker.allow()
+        ('closed', True)
+    '''
+
+    def __init__(self, name, window=20, min_calls=5, failure_rate=0.5,
+                 cooldown=30, probes=1):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.cooldown = cooldown
+        self.probes = probes
+
+        self.state = "closed"
+        self.opened_at = 0
+        self.rejected = 0
+
+        self._outcomes = collections.deque(maxlen=window)
+        self._probing = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        '''
+            True if a call may go through.
+        '''
+        with self._lock:
+            if self.state == "open":
+                if time.time() - self.opened_at < self.cooldown:
+                    self.rejected += 1
+                    return False
+                self.state = "half_open"
+                self._probing = 0
+
+            if self.state == "half_open":
+                if self._probing >= self.probes:
+                    self.rejected += 1
+                    return False
+                self._probing += 1
+
+            return True
+
+    def record(self, ok):
+        '''
+            Record the outcome of a call.
+        '''
+        with self._lock:
+            if self.state == "half_open":
+                if ok:
+                    self.state = "closed"
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return
+
+            self._outcomes.append(ok)
+
+            failures = self._outcomes.count(False)
+            if self.state == "closed" and \
+                    len(self._outcomes) >= self.min_calls and \
+                    failures >= self.failure_rate * len(self._outcomes):
+                self._open()
+
+    def cancel(self):
+        '''
+            A call ended without an outcome, let another probe through.
+        '''
+        with self._lock:
+            if self.state == "half_open" and self._probing > 0:
+                self._probing -= 1
+
+    def _open(self):
+        self.state = "open"
+        self.opened_at = time.time()
+        self._outcomes.clear()
+
+
+BREAKERS = {}
+BREAKERS_LOCK = threading.Lock()
+
+
+def get_breaker(engine):
+    '''
+        Return the circuit breaker for an engine.
+    '''
+    with BREAKERS_LOCK:
+        if engine not in BREAKERS:
+            BREAKERS[engine] = CircuitBreaker(engine,
+                                              BREAKER_WINDOW,
+                                              BREAKER_MIN_CALLS,
+                                              BREAKER_FAILURE_RATE,
+                                              BREAKER_COOLDOWN,
+                                              BREAKER_PROBES)
+        return BREAKERS[engine]
+
+
+def breaker_status():
+    '''
+        State and number of skipped calls per engine breaker.
+    '''
+    with BREAKERS_LOCK:
+        breakers = dict(BREAKERS)
+
+    return {engine: {"state": breakers[engine].state,
+                     "rejected": breakers[engine].rejected}
+            for engine in breakers}
+
+
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+BATCHERS = {}
+BATCHERS_LOCK = threading.Lock()
+
+# Functions that run a whole batch of texts for an engine.
+BATCH_FUNCTIONS = {"flair": flair_batch,
+                   "spacy": spacy_batch}
+
+
+def get_pool(engine):
+    '''
+        Return the worker pool for an engine, create it on first use.
+    '''
+    with POOLS_LOCK:
+        if engine not in POOLS:
+            POOLS[engine] = EnginePool(engine,
+                                       POOL_SIZE.get(engine, 1),
+                                       POOL_QUEUE_SIZE.get(engine, 16),
+                                       engine in PROCESS_ENGINES)
+        return POOLS[engine]
+
+
+def get_batcher(engine):
+    '''
+        Return the cross-request batcher for an engine,
+        or None if the engine is not batched.
+    '''
+    if engine not in BATCH_FUNCTIONS or BATCH_SIZE.get(engine, 1) <= 1:
+        return None
+
+    with BATCHERS_LOCK:
+        if engine not in BATCHERS:
+            BATCHERS[engine] = Batcher(
+                    engine,
+                    lambda texts, deadline: submit_engine_batch(engine,
+                                                                texts,
+                                                                deadline),
+                    BATCH_SIZE[engine],
+                    BATCH_LATENCY.get(engine, 0.05),
+                    BATCH_QUEUE_SIZE.get(engine, 256))
+        return BATCHERS[engine]
+
+
+def pool_status():
+    '''
+        Queue depth and number of busy workers per engine pool.
+    '''
+    with POOLS_LOCK:
+        pools = dict(POOLS)
+
+    with BATCHERS_LOCK:
+        batchers = dict(BATCHERS)
+
+    status = {engine: {"queued": pools[engine].depth(),
+                       "running": pools[engine].busy(),
+                       "size": pools[engine].size,
+                       "processes": pools[engine].processes}
+              for engine in pools}
+
+    for engine in batchers:
+        status.setdefault(engine, {})["batching"] = batchers[engine].depth()
+
+    return status
+
+
+def run_engine(engine, parsed_text, deadline=None):
+    '''
+        Run one engine on a text in the calling thread,
+        return the engine result.
+    '''
+    if engine in NETWORK_ENGINES and deadline is not None:
+        task = ENGINES[engine](parsed_text=parsed_text, deadline=deadline)
+    else:
+        task = ENGINES[engine](parsed_text=parsed_text)
+    task.run()
+    return task.result
+
+
+def init_engine_process(engine):
+    '''
+        Initializer for engine worker processes.
+    '''
+    if engine == "flair":
+        import torch
+        torch.set_num_threads(PROCESS_TORCH_THREADS)
+
+    if engine in MODEL_LOADERS:
+        get_model(engine)
+
+
+def run_engine_compact(engine, parsed_text):
+    '''
+        Run one engine inside a worker process.
+
+        Only (ne, pos, type) tuples and the timing travel back over IPC,
+        the result dict is rebuilt by expand_result.
+    '''
+    result = run_engine(engine, parsed_text)
+    entities = [(ne.get("ne"), ne.get("pos"), ne.get("type"))
+                for ne in result.get(engine, [])]
+    return engine, entities, result.get("timing_" + engine)
+
+
+def run_engine_batch(engine, texts):
+    '''
+        Run one engine on a batch of texts in the calling thread.
+    '''
+    return BATCH_FUNCTIONS[engine](texts)
+
+
+def run_engine_batch_compact(engine, texts):
+    '''
+        Batch version of run_engine_compact.
+    '''
+    results = run_engine_batch(engine, texts)
+    return [(engine,
+             [(ne.get("ne"), ne.get("pos"), ne.get("type"))
+              for ne in result.get(engine, [])],
+             result.get("timing_" + engine)) for result in results]
+
+
+def expand_result(compact):
+    '''
+        Turn the output of run_engine_compact back into an engine result.
+
+        >>> expand_result(("spacy", [("Einstein", 37, "person")], 0.1))
+        {'spacy': [{'ne': 'Einstein', 'pos': 37, 'type': 'person'}], \
+'timing_spacy': 0.1}
+    '''
+    engine, entities, timing = compact
+    result = {engine: [{"ne": ne, "pos": pos, "type": ne_type}
+                       for ne, pos, ne_type in entities]}
+    if timing is not None:
+        result["timing_" + engine] = timing
+    return result
+
+
+def chain_future(future, fn):
+    '''
+        Return a new future that resolves to fn(future.result()).
+    '''
+    chained = concurrent.futures.Future()
+
+    def done(f):
+        try:
+            chained.set_result(fn(f.result()))
+        except Exception as error:
+            chained.set_exception(error)
+
+    future.add_done_callback(done)
+    return chained
+
+
+def submit_engine_batch(engine, texts, deadline=None):
+    '''
+        Queue a batch job on the engine pool, waiting at most until
+        the deadline for room in its queue (DeadlineExceeded),
+        returns a future holding a list of engine results.
+    '''
+    pool = get_pool(engine)
+    if pool.processes:
+        return chain_future(pool.submit(run_engine_batch_compact,
+                                        engine,
+                                        texts,
+                                        deadline=deadline),
+                            lambda results: [expand_result(r)
+                                             for r in results])
+    return pool.submit(run_engine_batch, engine, texts, deadline=deadline)
+
+
+def submit_engine(engine, parsed_text, deadline=None):
+    '''
+        Queue an engine job, returns a future.
+
+        Batched engines go through their batcher, others are queued
+        on the engine pool directly, both wait at most until the deadline
+        for room in their queue (DeadlineExceeded).
+    '''
+    batcher = get_batcher(engine)
+    if batcher is not None:
+        return batcher.submit(parsed_text, deadline)
+
+    pool = get_pool(engine)
+    if pool.processes:
+        return chain_future(pool.submit(run_engine_compact,
+                                        engine,
+                                        parsed_text,
+                                        deadline=deadline),
+                            expand_result)
+    return pool.submit(run_engine, engine, parsed_text, deadline,
+                       deadline=deadline)
+
+
+class LRUCache(object):
+    '''
+        In-memory LRU cache of JSON encoded values,
+        evicts the least recently used entries once the total size
+        of the values exceeds max_bytes.
+
+        >>> cache = LRUCache(max_bytes=10)
+        >>> cache.put('a', '12345')
+        >>> cache.put('b', '12345')
+        >>> cache.get('a')
+        '12345'
+        >>> cache.put('c', '12345')
+        >>> cache.get('b') is None
+        True
+        >>> cache.size
+        10
+    '''
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._data:
+                self.size -= len(self._data.pop(key))
+
+            self._data[key] = value
+            self.size += len(value)
+
+            while self.size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class SQLiteCache(object):
+    '''
+        On-disk cache of JSON encoded values, shared between processes.
+
+        Once the total size exceeds max_bytes the least recently
+        used entries are removed.
+
+        >>> import os, tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'cache.sqlite')
+        >>> cache = SQLiteCache(path)
+        >>> cache.put('a', '[1, 2]')
+        >>> cache.get('a')
+        '[1, 2]'
+        >>> cache.get('b') is None
+        True
+    '''
+
+    # Check the total size after this many writes.
+    evict_every = 100
+
+    def __init__(self, path, max_bytes=1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+
+        self._local = threading.local()
+        self._writes = 0
+
+        conn = self._conn()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache ('
+                         'key TEXT PRIMARY KEY, '
+                         'value TEXT, '
+                         'size INTEGER, '
+                         'atime REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_atime '
+                         'ON cache (atime)')
+
+    def _conn(self):
+        # SQLite connections can't be shared between threads.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._conn()
+        row = conn.execute('SELECT value FROM cache WHERE key = ?',
+                           (key,)).fetchone()
+        if row is None:
+            return None
+
+        with conn:
+            conn.execute('UPDATE cache SET atime = ? WHERE key = ?',
+                         (time.time(), key))
+        return row[0]
+
+    def put(self, key, value):
+        conn = self._conn()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO cache '
+                         'VALUES (?, ?, ?, ?)',
+                         (key, value, len(value), time.time()))
+
+        self._writes += 1
+        if self._writes % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        conn = self._conn()
+        total = conn.execute('SELECT SUM(size) FROM cache').fetchone()[0]
+        if not total or total <= self.max_bytes:
+            return
+
+        keys = []
+        for key, size in conn.execute('SELECT key, size FROM cache '
+                                      'ORDER BY atime'):
+            keys.append((key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+        with conn:
+            conn.executemany('DELETE FROM cache WHERE key = ?', keys)
+
+
+class ResultCache(object):
+    '''
+        Two tier cache, memory first, then (optionally) disk,
+        with hit and miss counters.
+
+        >>> cache = ResultCache(LRUCache())
+        >>> cache.get('a') is None
+        True
+        >>> cache.put('a', [{'ne': 'Einstein'}])
+        >>> cache.get('a')
+        [{'ne': 'Einstein'}]
+        >>> cache.stats()['hits_memory'], cache.stats()['misses']
+        (1, 1)
+    '''
+
+    def __init__(self, memory=None, disk=None):
+        self.memory = memory
+        self.disk = disk
+        self.counters = {"hits_memory": 0, "hits_disk": 0, "misses": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def get(self, key):
+        value = None
+
+        if self.memory is not None:
+            value = self.memory.get(key)
+            if value is not None:
+                self._count("hits_memory")
+                return json.loads(value)
+
+        if self.disk is not None:
+            try:
+                value = self.disk.get(key)
+            except sqlite3.Error:
+                value = None
+
+            if value is not None:
+                self._count("hits_disk")
+                if self.memory is not None:
+                    self.memory.put(key, value)
+                return json.loads(value)
+
+        self._count("misses")
+        return None
+
+    def put(self, key, value):
+        value = json.dumps(value)
+
+        if self.memory is not None:
+            self.memory.put(key, value)
+
+        if self.disk is not None:
+            try:
+                self.disk.put(key, value)
+            except sqlite3.Error:
+                pass
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+
+        if self.memory is not None:
+            stats["memory_entries"] = len(self.memory)
+            stats["memory_bytes"] = self.memory.size
+
+        return stats
+
+
+RESULT_CACHE = None
+RESULT_CACHE_LOCK = threading.Lock()
+
+
+def get_cache():
+    '''
+        Return the result cache, create it on first use,
+        None if caching is disabled.
+    '''
+    global RESULT_CACHE
+
+    if not CACHE_MEMORY_BYTES and not CACHE_DB:
+        return None
+
+    with RESULT_CACHE_LOCK:
+        if RESULT_CACHE is None:
+            memory = disk = None
+            if CACHE_MEMORY_BYTES:
+                memory = LRUCache(CACHE_MEMORY_BYTES)
+            if CACHE_DB:
+                disk = SQLiteCache(CACHE_DB, CACHE_DB_BYTES)
+            RESULT_CACHE = ResultCache(memory, disk)
+        return RESULT_CACHE
+
+
+def cache_key(text, engines, *extra):
+    '''
+        Content hash for the result of the given engines on a text.
+
+        >>> key = cache_key("Einstein", ["spacy"])
+        >>> key == cache_key("Einstein", ["spacy"])
+        True
+        >>> key == cache_key("Einstein", ["flair"])
+        False
+    '''
+    key = hashlib.sha1(text.encode('utf-8'))
+
+    for engine in sorted(engines):
+        key.update(('\0%s=%s' % (engine,
+                                  MODEL_VERSIONS.get(engine, ''))).encode())
+
+    key.update(('\0confidence=%s' % SPOTLIGHT_CONFIDENCE).encode())
+
+    for value in extra:
+        key.update(('\0%r' % (value,)).encode('utf-8'))
+
+    return key.hexdigest()
+
+
+class Metric(object):
+    '''
+        Prometheus style counter, gauge or histogram, with labels,
+        rendered in the text exposition format.
+
+        >>> metric = Metric('test_seconds', 'Test.', 'histogram', (0.1, 1))
+        >>> metric.observe(0.5, engine='spacy')
+        >>> print(metric.render())
+        # HELP test_seconds Test.
+        # TYPE test_seconds histogram
+        test_seconds_bucket{engine="spacy",le="0.1"} 0
+        test_seconds_bucket{engine="spacy",le="1"} 1
+        test_seconds_bucket{engine="spacy",le="+Inf"} 1
+        test_seconds_sum{engine="spacy"} 0.5
+        test_seconds_count{engine="spacy"} 1
+        >>> metric = Metric('test_total', 'Test.')
+        >>> metric.inc(engine='stanford', reason='deadline')
+        >>> metric.inc(engine='stanford', reason='deadline')
+        >>> print(metric.render())
+        # HELP test_total Test.
+        # TYPE test_total counter
+        test_total{engine="stanford",reason="deadline"} 2
+    '''
+
+    def __init__(self, name, help, kind='counter', buckets=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.buckets = tuple(buckets)
+        self.reset()
+
+    def reset(self):
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = value
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0, 0]
+            entry = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self, labels=()):
+        '''
+            The metric in the text format, with `labels` added to
+            the labels of every value.
+        '''
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+
+        with self._lock:
+            for key, value in sorted(self.values.items()):
+                key += tuple(labels)
+                if self.kind != 'histogram':
+                    lines.append('%s%s %s' % (self.name,
+                                              metric_labels(key),
+                                              metric_number(value)))
+                    continue
+
+                counts, total, count = value
+                for bound, n in zip(self.buckets + ('+Inf',),
+                                    counts + [count]):
+                    lines.append('%s_bucket%s %s' % (
+                        self.name,
+                        metric_labels(key + (('le', metric_number(bound)),)),
+                        n))
+                lines.append('%s_sum%s %s' % (self.name,
+                                              metric_labels(key),
+                                              metric_number(total)))
+                lines.append('%s_count%s %s' % (self.name,
+                                                metric_labels(key),
+                                                count))
+
+        return '\n'.join(lines)
+
+
+def metric_labels(labels):
+    '''
+        Label pairs in the Prometheus text format.
+
+        >>> metric_labels((('engine', 'spacy'), ('le', '0.5')))
+        '{engine="spacy",le="0.5"}'
+        >>> metric_labels(())
+        ''
+    '''
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join(
+            '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                         .replace('"', '\\"')
+                                         .replace('\n', '\\n'))
+            for name, value in labels)
+
+
+def metric_number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+# Metrics collected while answering requests, per worker process,
+# the gauges on /metrics are read from the pools, cache and breakers
+# when scraped.
+ENGINE_SECONDS = Metric('ner_engine_seconds',
+                        'Engine run time per part, including retries.',
+                        'histogram', METRICS_LATENCY_BUCKETS)
+ENGINE_FAILURES = Metric('ner_engine_failures_total',
+                         'Engine runs left out of the answer, by reason '
+                         '(error, deadline or circuit_open).')
+REQUEST_SECONDS = Metric('ner_request_seconds',
+                         'Time to answer a text, without fetching it.',
+                         'histogram', METRICS_LATENCY_BUCKETS)
+REQUEST_CHARACTERS = Metric('ner_request_characters',
+                            'Size of the text of a request.',
+                            'histogram', METRICS_SIZE_BUCKETS)
+
+METRICS = [ENGINE_SECONDS, ENGINE_FAILURES,
+           REQUEST_SECONDS, REQUEST_CHARACTERS]
+
+
+def render_metrics():
+    '''
+        All metrics of this worker, in the Prometheus text format.
+
+        Every worker process (gunicorn WORKERS) counts for itself, and
+        a scrape of /metrics is answered by any one of them, so every
+        value has a pid label. Scraped often enough, every worker's
+        series stay current, add them up over the pid label:
+
+            sum without (pid) (rate(ner_request_seconds_count[5m]))
+    '''
+    queued = Metric('ner_queue_depth',
+                    'Jobs waiting for an engine pool worker (queue=pool), '
+                    'or for a batch (queue=batch).', 'gauge')
+    running = Metric('ner_pool_busy', 'Busy workers per engine pool.',
+                     'gauge')
+    for engine, status in pool_status().items():
+        if "queued" in status:
+            queued.set(status["queued"], engine=engine, queue="pool")
+            running.set(status["running"], engine=engine)
+        if "batching" in status:
+            queued.set(status["batching"], engine=engine, queue="batch")
+
+    breaker = Metric('ner_breaker_state',
+                     'Circuit breaker state per engine, 1 for the current '
+                     'state.', 'gauge')
+    rejected = Metric('ner_breaker_rejected_total',
+                      'Engine runs skipped by an open circuit breaker.')
+    for engine, status in breaker_status().items():
+        for state in ("closed", "open", "half_open"):
+            breaker.set(int(status["state"] == state),
+                        engine=engine, state=state)
+        rejected.set(status["rejected"], engine=engine)
+
+    metrics = METRICS + [queued, running, breaker, rejected]
+
+    cache = get_cache()
+    if cache is not None:
+        stats = cache.stats()
+        lookups = Metric('ner_cache_lookups_total',
+                         'Result cache lookups, by result and tier.')
+        lookups.set(stats["hits_memory"], result="hit", tier="memory")
+        lookups.set(stats["hits_disk"], result="hit", tier="disk")
+        lookups.set(stats["misses"], result="miss")
+
+        total = stats["hits_memory"] + stats["hits_disk"] + stats["misses"]
+        ratio = Metric('ner_cache_hit_ratio',
+                       'Result cache hits per lookup.', 'gauge')
+        ratio.set(float(total - stats["misses"]) / total if total else 0.0)
+
+        metrics += [lookups, ratio]
+
+        if "memory_bytes" in stats:
+            size = Metric('ner_cache_memory_bytes',
+                          'Size of the in-memory result cache.', 'gauge')
+            size.set(stats["memory_bytes"])
+            metrics.append(size)
+
+    labels = (('pid', os.getpid()),)
+    return '\n'.join(metric.render(labels) for metric in metrics) + '\n'
+
+
+# The trace of the request being handled, None if it isn't traced.
+TRACE = contextvars.ContextVar('trace', default=None)
+
+
+class Trace(object):
+    '''
+        The spans of one request.
+
+        >>> trace = Trace()
+        >>> with trace.span('request'):
+        ...     with trace.span('engine', engine='spacy') as attributes:
+        ...         attributes['entities'] = 2
+        >>> [span['name'] for span in trace.spans]
+        ['engine', 'request']
+        >>> trace.spans[0]['parent_id'] == trace.spans[1]['span_id']
+        True
+        >>> trace.spans[0]['attributes']
+        {'engine': 'spacy', 'entities': 2}
+    '''
+
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.spans = []
+        self.stack = []
+
+    def add(self, name, start, end, **attributes):
+        self.spans.append({"trace_id": self.trace_id,
+                           "span_id": os.urandom(8).hex(),
+                           "parent_id": self.stack[-1] if self.stack else None,
+                           "name": name,
+                           "start": start,
+                           "end": end,
+                           "attributes": attributes})
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        span_id = os.urandom(8).hex()
+        parent_id = self.stack[-1] if self.stack else None
+        self.stack.append(span_id)
+        start = time.time()
+
+        try:
+            yield attributes
+        finally:
+            self.stack.pop()
+            self.spans.append({"trace_id": self.trace_id,
+                               "span_id": span_id,
+                               "parent_id": parent_id,
+                               "name": name,
+                               "start": start,
+                               "end": time.time(),
+                               "attributes": attributes})
+
+
+@contextlib.contextmanager
+def traced(name, **attributes):
+    '''
+        Trace a request, if tracing is enabled and the request is sampled,
+        yields the Trace (or None), its spans are exported when it's done.
+    '''
+    if not (TRACE_FILE or TRACE_URL) or random.random() >= TRACE_SAMPLE:
+        yield None
+        return
+
+    trace = Trace()
+    token = TRACE.set(trace)
+
+    try:
+        with trace.span(name, **attributes):
+            yield trace
+    finally:
+        TRACE.reset(token)
+        export_trace(trace)
+
+
+@contextlib.contextmanager
+def trace_span(name, **attributes):
+    '''
+        A span in the trace of the current request, if it is traced,
+        yields the attributes of the span, to add to.
+    '''
+    trace = TRACE.get()
+
+    if trace is None:
+        yield attributes
+        return
+
+    with trace.span(name, **attributes) as attributes:
+        yield attributes
+
+
+TRACE_QUEUE = None
+TRACE_QUEUE_LOCK = threading.Lock()
+
+
+def export_trace(trace):
+    '''
+        Queue the spans of a trace for the exporter thread,
+        drop them if it can't keep up.
+    '''
+    global TRACE_QUEUE
+
+    with TRACE_QUEUE_LOCK:
+        if TRACE_QUEUE is None:
+            TRACE_QUEUE = queue.Queue(maxsize=1024)
+            threading.Thread(target=trace_exporter,
+                             args=(TRACE_QUEUE,),
+                             name='trace-exporter',
+                             daemon=True).start()
+
+    try:
+        TRACE_QUEUE.put_nowait(trace.spans)
+    except queue.Full:
+        pass
+
+
+def trace_exporter(spans_queue):
+    while True:
+        spans = spans_queue.get()
+
+        try:
+            if TRACE_FILE:
+                # One write per trace, the workers append to the same file.
+                with open(TRACE_FILE, 'a') as fh:
+                    fh.write(''.join(json.dumps(span) + '\n'
+                                     for span in spans))
+            if TRACE_URL:
+                requests.post(TRACE_URL, json=otlp_spans(spans), timeout=5)
+        except Exception:
+            pass
+
+
+def otlp_spans(spans):
+    '''
+        The spans in the OTLP/HTTP JSON format.
+
+        >>> body = otlp_spans([{"trace_id": "ab", "span_id": "cd",
+        ...                     "parent_id": None, "name": "context",
+        ...                     "start": 1.5, "end": 2.0,
+        ...                     "attributes": {"entities": 3}}])
+        >>> span = body["resourceSpans"][0]["scopeSpans"][0]["spans"][0]
+        >>> span["endTimeUnixNano"], span["attributes"]
+        ('2000000000', [{'key': 'entities', 'value': {'intValue': '3'}}])
+    '''
+    return {"resourceSpans": [{
+        "resource": {"attributes": [otlp_attribute("service.name", "ner")]},
+        "scopeSpans": [{
+            "scope": {"name": "ner"},
+            "spans": [{"traceId": span["trace_id"],
+                       "spanId": span["span_id"],
+                       "parentSpanId": span["parent_id"] or "",
+                       "name": span["name"],
+                       "kind": 1,
+                       "startTimeUnixNano": str(int(span["start"] * 1e9)),
+                       "endTimeUnixNano": str(int(span["end"] * 1e9)),
+                       "attributes": [otlp_attribute(key, value)
+                                      for key, value in
+                                      sorted(span["attributes"].items())]}
+                      for span in spans]}]}]}
+
+
+def otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class SamplingProfiler(object):
+    '''
+        Sample the stack of a thread, and of the busy engine pool threads,
+        from a background thread, and count the folded stacks.
+
+        >>> def busy(seconds):
+        ...     end = time.time() + seconds
+        ...     while time.time() < end:
+        ...         pass
+        >>> with SamplingProfiler(threading.get_ident(), 0.001) as profiler:
+        ...     busy(0.1)
+        >>> profiler.samples > 0
+        True
+        >>> 'busy (' in profiler.folded()
+        True
+    '''
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._loop,
+                                        name='profiler',
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _threads(self):
+        '''
+            Name per id of the threads to sample.
+        '''
+        threads = {self.thread_id: "request"}
+
+        for thread in threading.enumerate():
+            # Pool threads are named <engine>_<n>.
+            pool = thread.name.rsplit('_', 1)[0]
+            if pool in POOLS or thread.name.endswith('-batcher'):
+                threads[thread.ident] = pool
+
+        return threads
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            threads = self._threads()
+            frames = sys._current_frames()
+
+            for ident, name in threads.items():
+                if ident not in frames:
+                    continue
+
+                stack = []
+                frame = frames[ident]
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+
+                # Leave out idle workers, waiting for a job.
+                if ident != self.thread_id and idle_frame(stack[0]):
+                    continue
+
+                self.counts[(name,) + tuple(frame_label(code)
+                                            for code in reversed(stack))] += 1
+
+            self.samples += 1
+
+    def folded(self):
+        return '\n'.join('%s %d' % (';'.join(stack), count)
+                         for stack, count in sorted(self.counts.items()))
+
+
+def frame_label(code):
+    return '%s (%s:%d)' % (code.co_name,
+                           os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+def idle_frame(code):
+    '''
+        Is this the innermost frame of a thread waiting for work?
+    '''
+    filename = code.co_filename.replace(os.sep, '/')
+    return filename.endswith(('/threading.py', '/queue.py')) or \
+        (code.co_name == '_worker' and
+         filename.endswith('concurrent/futures/thread.py'))
+
+
+PROFILE_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def profiling(enabled=True):
+    '''
+        Profile the calling thread and the engine threads, yields the
+        SamplingProfiler, or None if profiling is disabled, or another
+        request is being profiled.
+    '''
+    if not enabled or not PROFILING_ENABLED or \
+            not PROFILE_LOCK.acquire(blocking=False):
+        yield None
+        return
+
+    try:
+        with SamplingProfiler(threading.get_ident()) as profiler:
+            yield profiler
+    finally:
+        PROFILE_LOCK.release()
+
+
+def profile_report(profiler):
+    '''
+        The samples of a profiler, as folded stacks,
+        also stored in PROFILE_DIR, if it's set.
+    '''
+    report = {"samples": profiler.samples,
+              "interval": profiler.interval,
+              "folded": profiler.folded()}
+
+    if PROFILE_DIR:
+        path = os.path.join(PROFILE_DIR, '%d-%d.folded' % (time.time() * 1000,
+                                                           os.getpid()))
+        with open(path, 'w') as fh:
+            fh.write(report["folded"] + '\n')
+        report["file"] = path
+
+    return report
+
+
+def intergrate_results(result, source, source_text, context_len,
+                       engines=None):
+    '''
+        Combine the output of the engines.
+
+        Stanford and Spotlight are leading, all their entities are kept,
+        entities of the other engines need two of them to agree.
+        If no leading engine was selected, at least two of the others
+        need to agree, or with fewer than two others, the one that's left
+        decides on its own:
+
+        >>> text = "Albert Einstein in Leiden en Amsterdam"
+        >>> result = {"spacy": [{"ne": "Albert Einstein", "pos": 0,
+        ...                      "type": "person"},
+        ...                     {"ne": "Leiden", "pos": 19,
+        ...                      "type": "location"}],
+        ...           "polyglot": [{"ne": "Albert Einstein", "pos": 0,
+        ...                         "type": "person"},
+        ...                        {"ne": "Amsterdam", "pos": 29,
+        ...                         "type": "location"}],
+        ...           "flair": [{"ne": "Albert Einstein", "pos": 0,
+        ...                      "type": "person"},
+        ...                     {"ne": "Leiden", "pos": 19,
+        ...                      "type": "location"}]}
+        >>> [(ne["ne"], ne["ner_src"]) for ne in intergrate_results(
+        ...     result, "p", text, 2, ["flair", "polyglot", "spacy"])]
+        ... # doctest: +NORMALIZE_WHITESPACE
+        [('Albert Einstein', ['spacy', 'polyglot', 'flair']),
+         ('Leiden', ['spacy', 'flair'])]
+    '''
+    if engines is None:
+        engines = ENGINES
+
+    leading = [p for p in ("stanford", "spotlight") if p in engines]
+    others = [p for p in ("spacy", "polyglot", "flair") if p in engines]
+
+    if leading:
+        # With a leading engine, the others need exactly two of them
+        # to agree, like it always was for all five engines.
+        agree = [2]
+    else:
+        agree = range(min(2, len(others)), len(others) + 1)
+
+    new_result = {}
+    res = []
+
+    for ne in result.get("stanford") or []:
+        res = {}
+        res["count"] = 1
+        res["ne"] = ne.get("ne")
+        res["ner_src"] = ["stanford"]
+        res["type"] = {ne.get("type"): 1}
+        res["pref_type"] = ne.get("type")
+        new_result[ne.get("pos")] = res
+
+    for ne in result.get("spotlight") or []:
+        if not ne.get("pos") in res:
+            res = {}
+            res["count"] = 1
+            res["ne"] = ne.get("ne")
+            res["ner_src"] = ["spotlight"]
+            res["type"] = {ne.get("type"): 1}
+            res["pref_type"] = ne.get("type")
+            new_result[ne.get("pos")] = res
+        else:
+            new_result[ne.get("pos")]["count"] += 1
+            new_result[ne.get("pos")]["ner_src"].append("spotlight")
+
+            if not ne.get("type") in new_result[ne.get("pos")]["type"]:
+                new_result[ne.get("pos")]["type"][ne.get("type")] = 1
+            else:
+                new_result[ne.get("pos")]["type"][ne.get("type")] += 1
+
+    parsers = ["spacy", "polyglot", "flair"]
+
+    for parser in parsers:
+        if result.get(parser) is None:
+            continue
+        for ne in result.get(parser):
+            if ne.get("pos") in new_result:
+
+                if parser in new_result[ne.get("pos")]["ner_src"]:
+                    continue
+
+                new_result[ne.get("pos")]["count"] += 1
+                new_result[ne.get("pos")]["ner_src"].append(parser)
+
+                if ne.get("type") in new_result[ne.get("pos")]["type"]:
+                    new_result[ne.get("pos")]["type"][ne.get("type")] += 1
+                else:
+                    new_result[ne.get("pos")]["type"][ne.get("type")] = 1
+
+                if not ne.get("ne") == new_result[ne.get("pos")].get("ne"):
+                    new_result[ne.get("pos")]["alt_ne"] = ne.get("ne")
+
+            else:
+                new_result[ne.get("pos")] = {
+                    "count": 1,
+                    "ne": ne.get("ne"),
+                    "ner_src": [parser],
+                    "type": {ne.get("type"): 1}}
+
+    kept = []
+    for ne in new_result:
+        if new_result[ne].get("pref_type") or \
+                len(new_result[ne].get("ner_src")) in agree:
+            if "pref_type" in new_result[ne]:
+                ne_type = max_class(new_result[ne]["type"],
+                                    new_result[ne]["pref_type"])
+                new_result[ne].pop("pref_type")
+            else:
+                ne_type = max_class(new_result[ne]["type"],
+                                    list(new_result[ne]["type"])[0])
+
+            new_result[ne]["types"] = list(new_result[ne]["type"])
+            new_result[ne]["type"] = ne_type[0]
+            new_result[ne]["type_certainty"] = ne_type[1]
+            kept.append(ne)
+
+    final_result = []
+    with trace_span("context", entities=len(kept)):
+        # One token index per part, shared by all its NE's.
+        index = TokenIndex(source_text) if kept else None
+
+        for ne in kept:
+            new_result[ne]["left_context"], \
+                new_result[ne]["right_context"], \
+                new_result[ne]["ne_context"] = context(source_text,
+                                                       new_result[ne]["ne"],
+                                                       ne,
+                                                       context_len,
+                                                       index)
+            new_result[ne]["pos"] = ne
+            if source:
+                new_result[ne]["source"] = source
+
+            final_result.append(new_result[ne])
+
+    final_result = sorted(final_result, key=operator.itemgetter('pos'))
+
+    return final_result
+
+
+def manual_find(input_str, source_text, source, context_len):
+    '''
+        Find occurrence of an 'ne' and
+        get the left and right context.
+    '''
+
+    result = {}
+
+    pos = source_text.find(input_str)
+    result["pos"] = pos
+    result["ne"] = input_str
+    result["source"] = source
+    result["type"] = 'manual'
+
+    try:
+        if not pos == -1:
+            result["left_context"],
+            result["right_context"],
+            result["ne_context"] = context(source_text,
+                                           input_str,
+                                           pos,
+                                           context_len)
+        else:
+            result["left_context"] = result["right_context"] = ''
+            result["ne_context"] = input_str
+    except:
+        pass
+
+    return result
+
+
+def max_class(input_type={"LOC": 2, "MISC": 3}, pref_type="LOC"):
+    mc = max(input_type, key=input_type.get)
+
+    if input_type.get(mc) == 1:
+        mc = pref_type
+        sure = 1
+    if input_type.get(mc) == 2:
+        sure = 2
+    if input_type.get(mc) == 3:
+        sure = 3
+    if input_type.get(mc) == 4:
+        sure = 4
+
+    return(mc, sure)
+
+
+def cached_results(part_text, cache, engines):
+    '''
+        Look up the raw output of the engines for a part,
+        returns the cached results, and the engines that still need to run.
+    '''
+    result = {}
+    missing = []
+
+    for p in engines:
+        if cache is not None:
+            # Raw engine output is cached per engine, so requests
+            # that only differ in context (or ne) skip the engines.
+            cached = cache.get(cache_key(part_text, [p]))
+            if cached is not None:
+                result[p] = cached
+                continue
+        missing.append(p)
+
+    return result, missing
+
+
+def add_result(result, timing, engine, ner_result, part_text, cache):
+    '''
+        Add the output of one engine to the results of a part,
+        and its time to the timing of the request.
+
+        >>> result, timing = {}, {"timing_spacy": 0.5}
+        >>> add_result(result, timing, "spacy",
+        ...            {"spacy": [], "timing_spacy": 0.25}, "Text", None)
+        >>> result, timing
+        ({'spacy': []}, {'timing_spacy': 0.75})
+    '''
+    key = "timing_" + engine
+
+    # Failed engines return no timing,
+    # don't cache their (empty) output.
+    if cache is not None and key in ner_result:
+        cache.put(cache_key(part_text, [engine]), ner_result[engine])
+
+    # Add timing information per parser.
+    if key in ner_result:
+        timing[key] = timing.get(key, 0) + ner_result[key]
+
+    # Add entities per parser result.
+    result[engine] = ner_result[engine]
+
+
+class EngineResults(object):
+    '''
+        The engine results of one request, per part,
+        with their timing, and the engines missing from the answer.
+    '''
+
+    def __init__(self, parsed_text, cache, engines, deadline=None):
+        self.parsed_text = parsed_text
+        self.cache = cache
+        self.engines_used = engines
+        self.deadline = deadline
+        self.results = {}
+        self.timing = {}
+        self.missing = {}
+        self.start_time = time.time()
+        self.trace = TRACE.get()
+        self.submitted = {}
+        self.finished = {}
+        self.allowed = {}
+        self.cancelled = set()
+
+    def engines(self, part):
+        '''
+            Fill in the cached results for a part,
+            and return the engines that still have to run.
+
+            The circuit breaker of an engine is asked once per request,
+            so a half-open breaker lets all parts of the probe through.
+        '''
+        self.results[part], engines = cached_results(self.parsed_text[part],
+                                                     self.cache,
+                                                     self.engines_used)
+
+        for p in engines:
+            if p not in self.allowed:
+                self.allowed[p] = get_breaker(p).allow()
+                if not self.allowed[p]:
+                    self.missing[p] = "circuit_open"
+                    ENGINE_FAILURES.inc(engine=p, reason="circuit_open")
+
+        return [p for p in engines if self.allowed[p]]
+
+    def submit(self, part, engine, job):
+        '''
+            Keep track of when the job (a future) of an engine
+            was submitted and done, for the trace of the request.
+        '''
+        if self.trace is not None:
+            self.submitted[part, engine] = time.time()
+            job.add_done_callback(
+                    lambda job: self.finished.update({(part, engine):
+                                                      time.time()}))
+        return job
+
+    def traced(self, part, engine, status, ner_result=None):
+        if self.trace is None or (part, engine) not in self.submitted:
+            return
+
+        start = self.submitted[part, engine]
+        end = self.finished.get((part, engine), time.time())
+        attributes = {"engine": engine, "part": part, "status": status}
+
+        # The engine timing is the execution time (for batched engines
+        # the share of this text in its batch), the rest was spent
+        # waiting for a worker, or for the other texts of the batch.
+        if ner_result and "timing_" + engine in ner_result:
+            attributes["execution"] = ner_result["timing_" + engine]
+            attributes["queue_wait"] = max(end - start -
+                                           attributes["execution"], 0)
+
+        self.trace.add("engine", start, end, **attributes)
+
+    def failed(self, engine, reason, part=None):
+        self.missing[engine] = reason
+
+        # Only errors of the engine itself count for its breaker,
+        # not running out of the time the caller gave the request.
+        if reason == "error":
+            get_breaker(engine).record(False)
+        elif engine not in self.cancelled:
+            self.cancelled.add(engine)
+            get_breaker(engine).cancel()
+
+        ENGINE_FAILURES.inc(engine=engine, reason=reason)
+        if part is not None:
+            self.traced(part, engine, reason)
+
+    def add(self, part, engine, ner_result):
+        # Failed engines return no timing, if the request deadline has
+        # passed, that's what stopped them, else it was an error, or
+        # the CALL_DEADLINE of the engine.
+        if "timing_" + engine not in ner_result:
+            if self.deadline is not None and time.time() >= self.deadline:
+                self.failed(engine, "deadline", part)
+            else:
+                self.failed(engine, "error", part)
+            return
+
+        self.traced(part, engine, "ok", ner_result)
+        get_breaker(engine).record(True)
+        ENGINE_SECONDS.observe(ner_result["timing_" + engine], engine=engine)
+        add_result(self.results[part],
+                   self.timing,
+                   engine,
+                   ner_result,
+                   self.parsed_text[part],
+                   self.cache)
+
+    def answer(self, text, manual, context_len):
+        answer = integrate_parts(self.parsed_text,
+                                 self.results,
+                                 text,
+                                 manual,
+                                 context_len,
+                                 self.timing,
+                                 self.missing,
+                                 self.engines_used)
+
+        REQUEST_SECONDS.observe(time.time() - self.start_time)
+        REQUEST_CHARACTERS.observe(sum(len(self.parsed_text[part])
+                                       for part in self.parsed_text))
+        return answer
+
+
+def integrate_parts(parsed_text, results, text, manual, context_len, timing,
+                    missing, engines=None):
+    '''
+        Integrate the engine results of all parts into the final answer.
+    '''
+    result_all = {}
+
+    fresult = []
+    for part in parsed_text:
+        if manual:
+            fresult.append(manual_find(manual,
+                                       parsed_text[part],
+                                       part,
+                                       context_len))
+
+        with trace_span("intergrate_results",
+                        part=part,
+                        characters=len(parsed_text[part])):
+            if text:
+                result_all[part] = intergrate_results(results[part],
+                                                      False,
+                                                      parsed_text[part],
+                                                      context_len,
+                                                      engines)
+            else:
+                result_all[part] = intergrate_results(results[part],
+                                                      part,
+                                                      parsed_text[part],
+                                                      context_len,
+                                                      engines)
+
+    for part in result_all:
+        if result_all[part]:
+            for item in result_all[part]:
+                fresult.append(item)
+
+    if text:
+        return {"entities": fresult,
+                "text": text,
+                "timing": timing,
+                "missing": missing}
+
+    return {"entities": fresult,
+            "text": parsed_text,
+            "timing": timing,
+            "missing": missing}
+
+
+def process(parsed_text, text=False, manual=None, context_len=5,
+            deadline=None, engines=None):
+    '''
+        Run the engines (default: DEFAULT_PROFILE) over every part of
+        parsed_text, and integrate their results into one answer.
+
+        Engines that did not finish before the deadline (a time.time()
+        timestamp), failed, or were skipped because their circuit breaker
+        is open, are left out, and listed in "missing".
+    '''
+    if engines is None:
+        engines = select_engines(None)
+
+    state = EngineResults(parsed_text, get_cache(), engines, deadline)
+
+    # Submit the jobs for all parts at once, parts of the same request
+    # end up in the same Flair and spaCy batches.
+    tasks = []
+    for part in parsed_text:
+        for p in state.engines(part):
+            try:
+                future = submit_engine(p, parsed_text[part], deadline)
+            except DeadlineExceeded:
+                # The engine pool stayed full until the deadline.
+                state.failed(p, "deadline", part)
+                continue
+            tasks.append((part, p, state.submit(part, p, future)))
+
+    if deadline is None:
+        timeout = None
+    else:
+        timeout = max(deadline - time.time(), 0)
+
+    done, _ = concurrent.futures.wait([f for _, _, f in tasks],
+                                      timeout=timeout)
+
+    for part, p, future in tasks:
+        if future not in done:
+            # Abandon it, if it has not started yet, it never will.
+            future.cancel()
+            state.failed(p, "deadline", part)
+            continue
+
+        try:
+            ner_result = future.result()
+        except DeadlineExceeded:
+            state.failed(p, "deadline", part)
+            continue
+        except Exception:
+            state.failed(p, "error", part)
+            continue
+
+        state.add(part, p, ner_result)
+
+    return state.answer(text, manual, context_len)
+
+
+def select_engines(value):
+    '''
+        Turn the engines argument, a profile name or a comma separated
+        list of engines, into a list of engines.
+
+        >>> select_engines(None) == sorted(ENGINE_PROFILES[DEFAULT_PROFILE])
+        True
+        >>> select_engines('stanford, spacy')
+        ['spacy', 'stanford']
+        >>> select_engines('stanford,bert')
+        Traceback (most recent call last):
+        ...
+        ValueError: Unknown engine(s) bert
+    '''
+    if not value:
+        value = DEFAULT_PROFILE
+
+    if value in ENGINE_PROFILES:
+        return sorted(ENGINE_PROFILES[value])
+
+    engines = sorted(set(engine.strip() for engine in value.split(',')
+                         if engine.strip()))
+
+    unknown = [engine for engine in engines
+               if engine not in ENABLED_ENGINES]
+    if unknown or not engines:
+        raise ValueError("Unknown engine(s) %s" % ", ".join(unknown))
+
+    return engines
+
+
+def request_deadline(value, start_time=None, max_deadline=None):
+    '''
+        Turn the deadline argument (seconds) into a timestamp,
+        at most max_deadline (default MAX_DEADLINE) seconds away.
+
+        >>> request_deadline('2', 100)
+        102.0
+        >>> request_deadline(None, 100) == 100 + DEFAULT_DEADLINE
+        True
+        >>> request_deadline('1e9', 100) == 100 + MAX_DEADLINE
+        True
+        >>> request_deadline('300', 100, 90) == 100 + 90
+        True
+        >>> request_deadline('nan', 100)
+        Traceback (most recent call last):
+        ...
+        ValueError: Invalid deadline nan
+    '''
+    if start_time is None:
+        start_time = time.time()
+
+    if max_deadline is None:
+        max_deadline = MAX_DEADLINE
+
+    if value in (None, ''):
+        seconds = DEFAULT_DEADLINE
+    else:
+        seconds = float(value)
+        if not math.isfinite(seconds):
+            raise ValueError("Invalid deadline %s" % value)
+
+    return start_time + min(max(seconds, 0), max_deadline)
+
+
+@application.route('/')
+def index():
+    text = request.args.get('text')
+    url = request.args.get('url')
+    manual = request.args.get('ne')
+    context_len = request.args.get('context')
+
+    try:
+        deadline = request_deadline(request.args.get('deadline'),
+                                    max_deadline=WSGI_MAX_DEADLINE)
+    except ValueError:
+        result = {"error": "Invalid deadline %s" %
+                           request.args.get('deadline')}
+        resp = Response(response=json.dumps(result),
+                        mimetype='application/json; charset=utf-8')
+        return (resp)
+
+    try:
+        engines = select_engines(request.args.get('engines'))
+    except ValueError as error:
+        result = {"error": str(error)}
+        resp = Response(response=json.dumps(result),
+                        mimetype='application/json; charset=utf-8')
+        return (resp)
+
+    profile = request.args.get('profile') in ('1', 'true')
+    if profile and not PROFILING_ENABLED:
+        result = {"error": "Profiling is disabled"}
+        resp = Response(response=json.dumps(result),
+                        mimetype='application/json; charset=utf-8')
+        return (resp)
+
+    if not context_len:
+        context_len = 5
+    else:
+        context_len = int(context_len)
+
+    if not url and not text:
+        result = {"error": "Missing argument ?text= or ?url=%s" % EXAMPLE_URL}
+        resp = Response(response=json.dumps(result),
+                        mimetype='application/json; charset=utf-8')
+        return (resp)
+
+    with traced("GET /") as trace:
+        parsed_text = False
+
+        if url:
+            try:
+                parsed_text = ocr_to_dict(url, deadline)
+            except Exception:
+                result = {"error": "Failed to fetch %s" % url}
+                resp = Response(response=json.dumps(result),
+                                mimetype='application/json; charset=utf-8')
+                return (resp)
+
+        if text:
+            parsed_text = {'p': text}
+
+        if parsed_text:
+            with profiling(profile) as profiler:
+                answer = process(parsed_text,
+                                 text,
+                                 manual,
+                                 context_len,
+                                 deadline,
+                                 engines)
+
+            if profiler is not None:
+                answer["profile"] = profile_report(profiler)
+            elif profile:
+                answer["profile"] = {
+                    "error": "Another request is being profiled"}
+
+            with trace_span("json.dumps"):
+                result = json.dumps(answer)
+
+            resp = Response(response=result,
+                            mimetype='application/json; charset=utf-8')
+
+            if trace is not None:
+                resp.headers['X-Trace-Id'] = trace.trace_id
+
+            return (resp)
+
+
+def process_item(item, max_deadline=None):
+    '''
+        Handle one item of a /batch call:
+
+            {"id": .., "text": .. or "url": .., "context": .., "ne": ..,
+             "deadline": .., "engines": .. (a string, or a list)}
+
+        Errors are reported per item, in the "error" field.
+        The deadline of the item is capped to max_deadline.
+
+        >>> process_item({"id": 1, "text": "Albert"}, time.time() - 1)
+        {'id': 1, 'error': 'Batch time limit exceeded'}
+        >>> process_item({"id": 2, "text": ["Albert"]})
+        {'id': 2, 'error': 'Invalid text'}
+        >>> process_item({"id": 3, "text": "Albert", "engines": ["bert"]})
+        {'id': 3, 'error': 'Unknown engine(s) bert'}
+    '''
+    result = {"id": item.get("id")}
+
+    if max_deadline is not None and time.time() >= max_deadline:
+        result["error"] = "Batch time limit exceeded"
+        return result
+
+    text = item.get("text")
+    url = item.get("url")
+
+    for field in ("text", "url", "ne"):
+        if not isinstance(item.get(field), (str, type(None))):
+            result["error"] = "Invalid %s" % field
+            return result
+
+    if not url and not text:
+        result["error"] = "Missing field text or url"
+        return result
+
+    context_len = item.get("context")
+    try:
+        if context_len in (None, ''):
+            context_len = 5
+        else:
+            context_len = int(context_len)
+    except (TypeError, ValueError):
+        result["error"] = "Invalid context %s" % item.get("context")
+        return result
+
+    try:
+        deadline = request_deadline(item.get("deadline"))
+    except (TypeError, ValueError):
+        result["error"] = "Invalid deadline %s" % item.get("deadline")
+        return result
+
+    if max_deadline is not None:
+        deadline = min(deadline, max_deadline)
+
+    engines = item.get("engines")
+    if isinstance(engines, list) and \
+            all(isinstance(engine, str) for engine in engines):
+        engines = ','.join(engines)
+
+    if not isinstance(engines, (str, type(None))):
+        result["error"] = "Invalid engines %s" % item.get("engines")
+        return result
+
+    try:
+        engines = select_engines(engines)
+    except ValueError as error:
+        result["error"] = str(error)
+        return result
+
+    with traced("batch item", id=str(item.get("id"))):
+        parsed_text = False
+
+        if url:
+            try:
+                parsed_text = ocr_to_dict(url, deadline)
+            except Exception:
+                result["error"] = "Failed to fetch %s" % url
+                return result
+
+        if text:
+            parsed_text = {'p': text}
+
+        result.update(process(parsed_text,
+                              text,
+                              item.get("ne"),
+                              context_len,
+                              deadline,
+                              engines))
+    return result
+
+
+def parse_batch(body):
+    '''
+        Parse the body of a /batch call, either a JSON array
+        or NDJSON (one JSON object per line).
+
+        >>> parse_batch('[{"id": 1, "text": "Albert"}]')
+        [{'id': 1, 'text': 'Albert'}]
+        >>> parse_batch('{"id": 1, "text": "a"}\\n\\n{"id": 2, "url": "b"}\\n')
+        [{'id': 1, 'text': 'a'}, {'id': 2, 'url': 'b'}]
+    '''
+    try:
+        items = json.loads(body)
+        if isinstance(items, dict):
+            items = [items]
+    except ValueError:
+        items = [json.loads(line) for line in body.splitlines()
+                 if line.strip()]
+
+    if not isinstance(items, list) or \
+            not all(isinstance(item, dict) for item in items):
+        raise ValueError("Expected a list of objects")
+
+    return items
+
+
+def imap_unordered(pool, fn, items, window):
+    '''
+        Submit fn(item) to pool for all items, with at most `window`
+        jobs in flight, yield the futures in order of completion.
+
+        >>> pool = EnginePool('test', size=2)
+        >>> sorted(f.result() for f in imap_unordered(pool, abs, [-1, 2], 1))
+        [1, 2]
+    '''
+    items = iter(items)
+    running = set()
+
+    while True:
+        for item in items:
+            running.add(pool.submit(fn, item))
+            if len(running) >= window:
+                break
+
+        if not running:
+            return
+
+        done, running = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+        for future in done:
+            yield future
 
-                if ne.get("type") in new_result[ne.get("pos")]["type"]:
-                    new_result[ne.get("pos")]["type"][ne.get("type")] += 1
-                else:
-                    new_result[ne.get("pos")]["type"][ne.get("type")] = 1
 
-                if not ne.get("ne") == new_result[ne.get("pos")].get("ne"):
-                    new_result[ne.get("pos")]["alt_ne"] = ne.get("ne")
+def stream_batch(items):
+    '''
+        Run all items, at most BATCH_WORKERS at a time, and yield
+        the NDJSON encoded results in order of completion,
+        within BATCH_MAX_SECONDS.
+    '''
+    max_deadline = time.time() + BATCH_MAX_SECONDS
 
-            else:
-                new_result[ne.get("pos")] = {
-                    "count": 1,
-                    "ne": ne.get("ne"),
-                    "ner_src": [parser],
-                    "type": {ne.get("type"): 1}}
+    def run_item(item):
+        try:
+            return process_item(item, max_deadline)
+        except Exception as error:
+            return {"id": item.get("id"), "error": str(error)}
 
-    final_result = []
-    for ne in new_result:
-        if new_result[ne].get("pref_type") or \
-                len(new_result[ne].get("ner_src")) == 2:
-            if "pref_type" in new_result[ne]:
-                ne_type = max_class(new_result[ne]["type"],
-                                    new_result[ne]["pref_type"])
-                new_result[ne].pop("pref_type")
-            else:
-                ne_type = max_class(new_result[ne]["type"],
-                                    list(new_result[ne]["type"])[0])
+    for future in imap_unordered(get_pool("batch"),
+                                 run_item,
+                                 items,
+                                 BATCH_WORKERS):
+        yield json.dumps(future.result()) + '\n'
 
-            new_result[ne]["types"] = list(new_result[ne]["type"])
-            new_result[ne]["type"] = ne_type[0]
-            new_result[ne]["type_certainty"] = ne_type[1]
 
-            new_result[ne]["left_context"], \
-                new_result[ne]["right_context"], \
-                new_result[ne]["ne_context"] = context(source_text,
-                                                       new_result[ne]["ne"],
-                                                       ne,
-                                                       context_len)
-            new_result[ne]["pos"] = ne
-            if source:
-                new_result[ne]["source"] = source
+@application.route('/batch', methods=['POST'])
+def batch():
+    try:
+        items = parse_batch(request.get_data(as_text=True))
+    except ValueError as error:
+        result = {"error": "Invalid batch: %s" % error}
+        resp = Response(response=json.dumps(result),
+                        status=400,
+                        mimetype='application/json; charset=utf-8')
+        return (resp)
 
-            final_result.append(new_result[ne])
+    if len(items) > BATCH_MAX_ITEMS:
+        result = {"error": "Too many items, max %d" % BATCH_MAX_ITEMS}
+        resp = Response(response=json.dumps(result),
+                        status=413,
+                        mimetype='application/json; charset=utf-8')
+        return (resp)
 
-    final_result = sorted(final_result, key=operator.itemgetter('pos'))
+    return Response(stream_batch(items),
+                    mimetype='application/x-ndjson; charset=utf-8')
 
-    return final_result
 
+WARMUP = {"state": "cold"}
+WARMUP_LOCK = threading.Lock()
 
-def manual_find(input_str, source_text, source, context_len):
+
+def run_warm_up():
     '''
-        Find occurrence of an 'ne' and
-        get the left and right context.
+        Load the models, and push WARMUP_TEXT through every enabled engine,
+        so the first real requests don't pay for it.
     '''
+    start_time = time.time()
+    engines = {}
 
-    result = {}
+    try:
+        warm_up()
+
+        tasks = [(p, submit_engine(p, WARMUP_TEXT)) for p in ENABLED_ENGINES]
+        for p, future in tasks:
+            try:
+                ner_result = future.result(timeout=WARMUP_TIMEOUT)
+                engines[p] = "ok" if "timing_" + p in ner_result else "error"
+            except Exception:
+                engines[p] = "error"
+    except Exception as error:
+        WARMUP.update({"state": "failed",
+                       "error": str(error),
+                       "failed_at": time.time()})
+        return
+
+    WARMUP.pop("error", None)
+    WARMUP.update({"state": "ready",
+                   "engines": engines,
+                   "took": time.time() - start_time})
+
+
+def start_warm_up():
+    '''
+        Start the warm-up in the background, once per worker,
+        or again once the backoff after a failed warm-up has passed.
+    '''
+    with WARMUP_LOCK:
+        if WARMUP["state"] == "failed":
+            backoff = min(WARMUP_RETRY_BACKOFF *
+                          2 ** (WARMUP.get("attempts", 1) - 1),
+                          WARMUP_RETRY_MAX_BACKOFF)
+            if time.time() < WARMUP["failed_at"] + backoff:
+                return
+        elif WARMUP["state"] != "cold":
+            return
+        WARMUP.update({"state": "warming",
+                       "attempts": WARMUP.get("attempts", 0) + 1})
+
+    threading.Thread(target=run_warm_up, name='warm-up', daemon=True).start()
+
+
+def readiness():
+    '''
+        Returns (ready, report), with the loaded state of every engine,
+        and the reachability of the Stanford and Spotlight backends.
+    '''
+    start_warm_up()
+
+    loaded = model_status()
+    breakers = breaker_status()
+
+    engines = {}
+    for engine in ENABLED_ENGINES:
+        engines[engine] = {"loaded": loaded[engine]}
+        if engine in breakers:
+            engines[engine]["breaker"] = breakers[engine]["state"]
+
+    backends = {}
+    reachable = True
+    for engine in NETWORK_ENGINES:
+        if engine not in ENABLED_ENGINES:
+            continue
+        backends[engine] = []
+        for backend in get_backends(engine).backends:
+            ok = backend.check(timeout=0.5)
+            reachable = reachable and ok
+            backends[engine].append({"backend": repr(backend),
+                                     "reachable": ok})
+
+    ready = WARMUP["state"] == "ready" and all(loaded.values())
+    if READY_REQUIRES_BACKENDS:
+        ready = ready and reachable
+
+    return ready, {"ready": ready,
+                   "warm_up": dict(WARMUP),
+                   "engines": engines,
+                   "backends": backends}
+
+
+@application.route('/healthz')
+def healthz():
+    result = {"alive": True, "pid": os.getpid()}
+    return Response(response=json.dumps(result),
+                    mimetype='application/json; charset=utf-8')
+
+
+@application.route('/readyz')
+def readyz():
+    ready, result = readiness()
+    return Response(response=json.dumps(result),
+                    status=200 if ready else 503,
+                    mimetype='application/json; charset=utf-8')
+
+
+@application.route('/metrics')
+def metrics():
+    return Response(response=render_metrics(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+# The asyncio request path, Stanford and Spotlight calls are coroutines,
+# so one worker can keep many backend calls in flight without a thread
+# per call, the CPU-bound engines run on their engine pools.
+#
+#     $ uvicorn ner:asgi_application --port 8099
+#
+# Maximum number of simultaneous Stanford/Spotlight calls per event loop.
+ASYNC_MAX_CALLS = 1024
+
+ASYNC_SLOTS = {}
+
+
+def async_slots():
+    '''
+        Semaphore bounding the backend calls on the running event loop.
+    '''
+    loop = asyncio.get_event_loop()
+    if loop not in ASYNC_SLOTS:
+        ASYNC_SLOTS[loop] = asyncio.Semaphore(ASYNC_MAX_CALLS)
+    return ASYNC_SLOTS[loop]
+
+
+async def call_with_retry_async(fn, deadline, retries=None):
+    '''
+        Coroutine version of call_with_retry.
+    '''
+    if retries is None:
+        retries = RETRY_MAX
+
+    attempt = 0
+    while True:
+        if time.time() >= deadline:
+            raise DeadlineExceeded()
+
+        try:
+            return await fn(deadline)
+        except Exception:
+            attempt += 1
+            delay = min(RETRY_BACKOFF * 2 ** (attempt - 1), RETRY_BACKOFF_MAX)
+            if attempt > retries or time.time() + delay >= deadline:
+                raise
+            await asyncio.sleep(delay)
 
-    pos = source_text.find(input_str)
-    result["pos"] = pos
-    result["ne"] = input_str
-    result["source"] = source
-    result["type"] = 'manual'
 
+async def exchange_async(backend, request_data, deadline, read=None):
+    '''
+        Send request_data to backend, and return read(reader),
+        by default everything until the backend closes the connection.
+    '''
+    reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(backend.host, backend.port),
+            remaining(deadline))
     try:
-        if not pos == -1:
-            result["left_context"],
-            result["right_context"],
-            result["ne_context"] = context(source_text,
-                                           input_str,
-                                           pos,
-                                           context_len)
-        else:
-            result["left_context"] = result["right_context"] = ''
-            result["ne_context"] = input_str
-    except:
-        pass
+        writer.write(request_data)
+        await writer.drain()
+        if read is None:
+            read = lambda reader: reader.read()
+        return await asyncio.wait_for(read(reader), remaining(deadline))
+    finally:
+        writer.close()
 
-    return result
 
+async def read_http_response(reader):
+    '''
+        Read one HTTP response, returns (status, body).
+    '''
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ', 2)[1])
 
-def max_class(input_type={"LOC": 2, "MISC": 3}, pref_type="LOC"):
-    mc = max(input_type, key=input_type.get)
+    length = None
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value.strip())
 
-    if input_type.get(mc) == 1:
-        mc = pref_type
-        sure = 1
-    if input_type.get(mc) == 2:
-        sure = 2
-    if input_type.get(mc) == 3:
-        sure = 3
-    if input_type.get(mc) == 4:
-        sure = 4
+    if length is None:
+        return status, await reader.read()
+    return status, await reader.readexactly(length)
 
-    return(mc, sure)
 
+async def stanford_async(parsed_text, deadline, caller_deadline=None):
+    '''
+        Coroutine version of the Stanford engine.
+    '''
+    group = get_backends("stanford")
+    request_data = parsed_text.replace('\n', ' ').encode('utf-8') + b'\n'
+
+    async def tag(deadline):
+        with group.use(caller_deadline) as backend:
+            return await exchange_async(backend, request_data, deadline)
 
-@application.route('/')
-def index():
-    parsers = {"flair": Flair,
-               "polyglot": Polyglot,
-               "spacy": Spacy,
-               "spotlight": Spotlight,
-               "stanford": Stanford}
+    async with async_slots():
+        raw_data = await call_with_retry_async(tag, deadline)
 
-    text = request.args.get('text')
-    url = request.args.get('url')
-    manual = request.args.get('ne')
-    context_len = request.args.get('context')
+    return stanford_result(parsed_text, raw_data.decode('utf-8'))
 
-    if not context_len:
-        context_len = 5
-    else:
-        context_len = int(context_len)
 
-    if not url and not text:
-        result = {"error": "Missing argument ?text= or ?url=%s" % EXAMPLE_URL}
-        resp = Response(response=json.dumps(result),
-                        mimetype='application/json; charset=utf-8')
-        return (resp)
+async def spotlight_async(parsed_text, confidence, deadline,
+                          caller_deadline=None):
+    '''
+        Coroutine version of the Spotlight engine.
+
+        Uses a HTTP/1.0 POST, so the answer is never chunked.
+    '''
+    group = get_backends("spotlight")
+    body = urllib.parse.urlencode({'text': parsed_text,
+                                   'confidence': str(confidence)}).encode()
+
+    async def annotate(deadline):
+        with group.use(caller_deadline) as backend:
+            request_data = ('POST %s HTTP/1.0\r\n'
+                            'Host: %s:%s\r\n'
+                            'Accept: application/json\r\n'
+                            'Connection: close\r\n'
+                            'Content-Type: application/x-www-form-urlencoded'
+                            '\r\n'
+                            'Content-Length: %d\r\n\r\n' % (
+                                SPOTLIGHT_PATH,
+                                backend.host,
+                                backend.port,
+                                len(body))).encode('ascii') + body
+
+            status, data = await exchange_async(backend,
+                                                request_data,
+                                                deadline,
+                                                read_http_response)
+            if status != 200:
+                raise IOError('Spotlight answered %d' % status)
+
+            return json.loads(data.decode('utf-8'))
+
+    async with async_slots():
+        data = await call_with_retry_async(annotate, deadline)
+
+    return spotlight_result(data)
+
+
+async def run_engine_async(engine, parsed_text, deadline=None):
+    '''
+        Run one engine from the event loop, returns the engine result.
+
+        The network engines are coroutines, the others
+        run on their engine pool.
+    '''
+    if engine not in NETWORK_ENGINES:
+        # submit_engine() blocks while the engine pool queue is full,
+        # keep that off the event loop.
+        future = await asyncio.get_event_loop().run_in_executor(
+                None, submit_engine, engine, parsed_text, deadline)
+        return await asyncio.wrap_future(future)
+
+    start_time = time.time()
+
+    try:
+        if engine == "stanford":
+            result = await stanford_async(parsed_text,
+                                          call_deadline(start_time, deadline),
+                                          deadline)
+        else:
+            result = await spotlight_async(parsed_text,
+                                           SPOTLIGHT_CONFIDENCE,
+                                           call_deadline(start_time,
+                                                         deadline),
+                                           deadline)
+    except Exception:
+        return {engine: []}
+
+    return {engine: result,
+            "timing_" + engine: time.time() - start_time}
+
+
+async def process_async(parsed_text, text=False, manual=None, context_len=5,
+                        deadline=None, engines=None):
+    '''
+        Coroutine version of process().
+    '''
+    if engines is None:
+        engines = select_engines(None)
+
+    state = EngineResults(parsed_text, get_cache(), engines, deadline)
+
+    jobs = []
+    for part in parsed_text:
+        for p in state.engines(part):
+            jobs.append((part, p, state.submit(part, p, asyncio.ensure_future(
+                run_engine_async(p, parsed_text[part], deadline)))))
 
-    parsed_text = False
+    if jobs:
+        if deadline is None:
+            timeout = None
+        else:
+            timeout = max(deadline - time.time(), 0)
+
+        done, _ = await asyncio.wait([job for _, _, job in jobs],
+                                     timeout=timeout)
+
+    for part, p, job in jobs:
+        if job not in done:
+            job.cancel()
+            state.failed(p, "deadline", part)
+            continue
 
-    if url:
         try:
-            parsed_text = ocr_to_dict(url)
+            ner_result = job.result()
+        except DeadlineExceeded:
+            state.failed(p, "deadline", part)
+            continue
         except Exception:
-            result = {"error": "Failed to fetch %s" % url}
-            resp = Response(response=json.dumps(result),
-                            mimetype='application/json; charset=utf-8')
-            return (resp)
+            state.failed(p, "error", part)
+            continue
 
-    if text:
-        parsed_text = {'p': text}
+        state.add(part, p, ner_result)
+
+    return state.answer(text, manual, context_len)
 
-    timing = {}
 
-    if parsed_text:
-        result_all = {}
+async def asgi_send_json(send, result, status=200):
+    with trace_span("json.dumps"):
+        body = json.dumps(result).encode('utf-8')
+    await send({"type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type",
+                             b"application/json; charset=utf-8"),
+                            (b"content-length",
+                             str(len(body)).encode('ascii'))]})
+    await send({"type": "http.response.body", "body": body})
 
-        fresult = []
-        for part in parsed_text:
-            result = {}
-            tasks = []
 
-            if manual:
-                fresult.append(manual_find(manual,
-                                           parsed_text[part],
-                                           part,
-                                           context_len))
+async def asgi_application(scope, receive, send):
+    '''
+        ASGI version of the web-service, answers GET / like index(),
+        and /healthz, /readyz and /metrics.
+    '''
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    if scope["path"] == "/healthz":
+        await asgi_send_json(send, {"alive": True, "pid": os.getpid()})
+        return
+
+    if scope["path"] == "/readyz":
+        ready, result = await asyncio.get_event_loop().run_in_executor(
+                None, readiness)
+        await asgi_send_json(send, result, 200 if ready else 503)
+        return
+
+    if scope["path"] == "/metrics":
+        body = render_metrics().encode('utf-8')
+        await send({"type": "http.response.start",
+                    "status": 200,
+                    "headers": [(b"content-type",
+                                 b"text/plain; version=0.0.4; charset=utf-8"),
+                                (b"content-length",
+                                 str(len(body)).encode('ascii'))]})
+        await send({"type": "http.response.body", "body": body})
+        return
+
+    if scope["path"] != "/":
+        await asgi_send_json(send, {"error": "Not found"}, 404)
+        return
+
+    args = urllib.parse.parse_qs(scope["query_string"].decode('utf-8'))
+    text = args.get('text', [None])[0]
+    url = args.get('url', [None])[0]
+    manual = args.get('ne', [None])[0]
+    context_len = args.get('context', [None])[0]
 
-            for p in parsers:
-                tasks.append(parsers[p](parsed_text=parsed_text[part]))
-                tasks[-1].start()
+    try:
+        deadline = request_deadline(args.get('deadline', [None])[0])
+    except ValueError:
+        await asgi_send_json(send, {"error": "Invalid deadline"})
+        return
 
-            for p in tasks:
-                ner_result = p.join()
+    try:
+        engines = select_engines(args.get('engines', [None])[0])
+    except ValueError as error:
+        await asgi_send_json(send, {"error": str(error)})
+        return
 
-                # Add timing information per parser.
-                try:
-                    if not list(ner_result)[1] in timing:
-                        timing[list(ner_result)[1]] = \
-                            ner_result[list(ner_result)[1]]
-                    else:
-                        timing[list(ner_result)[1]] += \
-                            ner_result[list(ner_result)[1]]
-                except:
-                    pass
+    if not context_len:
+        context_len = 5
+    else:
+        context_len = int(context_len)
 
-                # Add entities per parser result.
-                result[list(ner_result)[0]] = ner_result[list(ner_result)[0]]
+    if not url and not text:
+        await asgi_send_json(send, {
+            "error": "Missing argument ?text= or ?url=%s" % EXAMPLE_URL})
+        return
 
-            if text:
-                result_all[part] = intergrate_results(result,
-                                                      False,
-                                                      parsed_text[part],
-                                                      context_len)
-            else:
-                result_all[part] = intergrate_results(result,
-                                                      part,
-                                                      parsed_text[part],
-                                                      context_len)
+    with traced("GET /"):
+        parsed_text = False
 
-        for part in result_all:
-            if result_all[part]:
-                for item in result_all[part]:
-                    fresult.append(item)
+        if url:
+            try:
+                # Run it in the context of this request, so its spans
+                # end up in the trace.
+                parsed_text = await asyncio.get_event_loop().run_in_executor(
+                        None, contextvars.copy_context().run, ocr_to_dict, url,
+                        deadline)
+            except Exception:
+                await asgi_send_json(send,
+                                     {"error": "Failed to fetch %s" % url})
+                return
 
         if text:
-            result = json.dumps({"entities": fresult,
-                                 "text": text,
-                                 "timing": timing})
-        else:
-            result = json.dumps({"entities": fresult,
-                                 "text": parsed_text,
-                                 "timing": timing})
+            parsed_text = {'p': text}
 
-        resp = Response(response=result,
-                        mimetype='application/json; charset=utf-8')
+        await asgi_send_json(send, await process_async(parsed_text,
+                                                       text,
+                                                       manual,
+                                                       context_len,
+                                                       deadline,
+                                                       engines))
 
-        return (resp)
 
+def preload():
+    '''
+        Load the models before forking (gunicorn --preload),
+        so the workers share the model pages copy-on-write.
+
+        The loaded objects are moved into the permanent generation,
+        so the garbage collector in the workers doesn't touch
+        (and copy) them. Don't run any inference before the fork,
+        the torch/OpenMP worker threads don't survive it.
+    '''
+    # Only Flair runs on torch, don't pay for importing it otherwise.
+    if "flair" in ENABLED_ENGINES:
+        import torch
+        torch.set_num_threads(TORCH_THREADS)
+
+    warm_up()
 
-def ocr_to_dict(url):
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+def after_fork():
+    '''
+        Reset the state that does not survive a fork,
+        threads, held locks, sockets and SQLite connections
+        belong to the parent process.
+    '''
+    global BACKENDS, BACKENDS_LOCK
+    global STANFORD_CLIENT, STANFORD_CLIENT_LOCK
+    global SPOTLIGHT_CLIENT, SPOTLIGHT_CLIENT_LOCK
+    global BREAKERS, BREAKERS_LOCK
+    global POOLS, POOLS_LOCK, BATCHERS, BATCHERS_LOCK
+    global RESULT_CACHE, RESULT_CACHE_LOCK
+    global MODEL_LOCKS, ASYNC_SLOTS, WARMUP, WARMUP_LOCK
+    global TRACE_QUEUE, TRACE_QUEUE_LOCK, PROFILE_LOCK
+
+    BACKENDS, BACKENDS_LOCK = {}, threading.Lock()
+    STANFORD_CLIENT, STANFORD_CLIENT_LOCK = None, threading.Lock()
+    SPOTLIGHT_CLIENT, SPOTLIGHT_CLIENT_LOCK = None, threading.Lock()
+    BREAKERS, BREAKERS_LOCK = {}, threading.Lock()
+    POOLS, POOLS_LOCK = {}, threading.Lock()
+    BATCHERS, BATCHERS_LOCK = {}, threading.Lock()
+    RESULT_CACHE, RESULT_CACHE_LOCK = None, threading.Lock()
+    MODEL_LOCKS = {engine: threading.Lock() for engine in MODEL_LOADERS}
+    ASYNC_SLOTS = {}
+    WARMUP, WARMUP_LOCK = {"state": "cold"}, threading.Lock()
+    TRACE_QUEUE, TRACE_QUEUE_LOCK = None, threading.Lock()
+    PROFILE_LOCK = threading.Lock()
+
+    for metric in METRICS:
+        metric.reset()
+
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(TORCH_THREADS)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=after_fork)
+
+
+def ocr_to_dict(url, deadline=None):
     '''
         Fetch some OCR from the KB / Depher newspaper collection,
-        remove the XML-tags, and put it into a dictionary:
+        remove the XML-tags, and put it into a dictionary.
+        With a deadline (a time.time() timestamp) the fetch, retries
+        included, raises DeadlineExceeded once it has passed:
 
         >>> EXAMPLE_URL = "http://resolver.kb.nl/resolve?"
         >>> EXAMPLE_URL += "urn=ddd:010381561:mpeg21:a0049:ocr"
@@ -765,19 +3905,48 @@ def ocr_to_dict(url):
     done = False
     retry = 0
 
-    while not done:
-        try:
-            req = requests.get(url, timeout=TIMEOUT)
-            if req.status_code == 200:
-                done = True
-            retry += 1
-            if retry > 50:
-                done = True
-        except Exception:
-            done = False
+    with trace_span("fetch", url=url) as span:
+        while not done:
+            timeout = TIMEOUT
+            if deadline is not None:
+                timeout = min(TIMEOUT, remaining(deadline))
+
+            try:
+                req = requests.get(url, timeout=timeout)
+                if req.status_code == 200:
+                    done = True
+                retry += 1
+                if retry > 50:
+                    done = True
+            except Exception:
+                # Give up eventually, instead of hanging the caller forever.
+                retry += 1
+                if retry > 50:
+                    raise
+
+            if not done:
+                delay = min(RETRY_BACKOFF * 2 ** (retry - 1),
+                            RETRY_BACKOFF_MAX)
+                if deadline is not None:
+                    delay = min(delay, max(deadline - time.time(), 0))
+                time.sleep(delay)
+
+        span["attempts"] = retry
+        span["bytes"] = len(req.content)
+
+    with trace_span("parse"):
+        return xml_to_dict(req.content)
+
+
+def xml_to_dict(content):
+    '''
+        Remove the XML-tags from KB OCR, and put it into a dictionary:
 
-    text = req.content
-    text = text.decode('utf-8')
+        >>> xml_to_dict(b"<text><title>Kop</title>"
+        ...             b"<p>Een</p><p> twee</p></text>")
+        {'title': 'Kop', 'p': 'Een twee'}
+    '''
+    text = content.decode('utf-8')
 
     parser = lxml.etree.XMLParser(ns_clean=False,
                                   recover=True,
@@ -811,6 +3980,199 @@ def ocr_to_dict(url):
     return parsed_text
 
 
+def file_to_dict(path):
+    '''
+        Read a KB OCR XML file from disk into a dictionary.
+    '''
+    with open(path, 'rb') as fh:
+        return xml_to_dict(fh.read())
+
+
+def bulk_sources(sources):
+    '''
+        Yield (id, loader) for every item in the given sources,
+        loader() returns the parsed text of the item.
+
+        A source is a directory (searched for *.xml), a tarball
+        with *.xml members, or a file listing urn's or urls, one per line.
+    '''
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.endswith('.xml'):
+                        path = os.path.join(root, name)
+                        yield path, functools.partial(file_to_dict, path)
+        elif tarfile.is_tarfile(source):
+            with tarfile.open(source) as tar:
+                for member in tar:
+                    if not member.isfile() or \
+                            not member.name.endswith('.xml'):
+                        continue
+                    # Tarfiles can't be read from multiple threads,
+                    # so the member is read here, and parsed by a worker.
+                    content = tar.extractfile(member).read()
+                    yield member.name, functools.partial(xml_to_dict,
+                                                         content)
+        else:
+            with open(source) as fh:
+                for line in fh:
+                    urn = line.strip()
+                    if not urn or urn.startswith('#'):
+                        continue
+                    if '://' in urn:
+                        url = urn
+                    else:
+                        url = RESOLVER_URL + urn
+                    yield urn, functools.partial(ocr_to_dict, url)
+
+
+def bulk_item(item, context_len=5, engines=None):
+    '''
+        Load and process one bulk item, errors are reported per item.
+    '''
+    item_id, loader = item
+    result = {"id": item_id}
+
+    try:
+        parsed_text = loader()
+    except Exception as error:
+        result["error"] = "Failed to load %s: %s" % (item_id, error)
+        return result
+
+    result.update(process(parsed_text, False, None, context_len,
+                          engines=engines))
+    return result
+
+
+def bulk(sources, out_dir, shards=8, workers=32, context_len=5,
+         report_every=10, engines=None):
+    '''
+        Process all items from sources, without the web-service,
+        and write the results to `shards` NDJSON files in out_dir.
+
+        Items are sharded on a hash of their id, so reprocessing
+        the same corpus puts every item in the same shard again.
+    '''
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    outputs = [open(os.path.join(out_dir, 'part-%05d.ndjson' % i),
+                    'w',
+                    encoding='utf-8') for i in range(shards)]
+
+    POOL_SIZE["batch"] = workers
+    pool = get_pool("batch")
+
+    start_time = last_report = time.time()
+    count = errors = size = 0
+
+    def report(final=False):
+        elapsed = max(time.time() - start_time, 1e-9)
+        sys.stderr.write('%s %d items (%d errors) in %.1fs, '
+                         '%.1f items/s, %.1f kB/s\n' % (
+                             'Done,' if final else 'Processed',
+                             count, errors, elapsed,
+                             count / elapsed,
+                             size / 1024.0 / elapsed))
+        sys.stderr.flush()
+
+    try:
+        for future in imap_unordered(pool,
+                                     functools.partial(bulk_item,
+                                                       context_len=context_len,
+                                                       engines=engines),
+                                     bulk_sources(sources),
+                                     workers * 2):
+            result = future.result()
+
+            count += 1
+            if "error" in result:
+                errors += 1
+            elif isinstance(result.get("text"), dict):
+                size += sum(len(t) for t in result["text"].values())
+
+            shard = int(hashlib.md5(str(result["id"]).encode(
+                'utf-8')).hexdigest()[:8], 16) % shards
+            outputs[shard].write(json.dumps(result) + '\n')
+
+            if time.time() - last_report >= report_every:
+                last_report = time.time()
+                report()
+    finally:
+        for output in outputs:
+            output.close()
+
+    report(final=True)
+    return errors
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+            description='MultiNER, combined output of five NER engines.')
+    commands = parser.add_subparsers(dest='command')
+
+    commands.add_parser('test', help='run the doctests (default)')
+
+    bulk_parser = commands.add_parser(
+            'bulk',
+            help='process a corpus of KB OCR XML files '
+                 'without the web-service')
+    bulk_parser.add_argument('sources',
+                             nargs='+',
+                             help='directory, tarball or file with '
+                                  'urn\'s/urls (one per line)')
+    bulk_parser.add_argument('-o', '--out', required=True,
+                             help='output directory for the NDJSON shards')
+    bulk_parser.add_argument('--shards', type=int, default=8)
+    bulk_parser.add_argument('--workers', type=int, default=32,
+                             help='number of items processed at once')
+    bulk_parser.add_argument('--context', type=int, default=5)
+    bulk_parser.add_argument('--engines',
+                             type=select_engines,
+                             default=None,
+                             help='profile name, or comma separated '
+                                  'list of engines')
+    bulk_parser.add_argument('--report-every', type=float, default=10,
+                             help='seconds between progress reports')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'bulk':
+        errors = bulk(args.sources,
+                      args.out,
+                      args.shards,
+                      args.workers,
+                      args.context,
+                      args.report_every,
+                      args.engines)
+        return 1 if errors else 0
+
+    import doctest
+    return 1 if doctest.testmod(verbose=True).failed else 0
+
+
+def test_import_time():
+    '''
+    Importing ner.py should be quick, and not load any model:
+
+    >>> import subprocess
+    >>> cwd = os.path.dirname(os.path.abspath(__file__))
+    >>> code = "import time; t = time.time(); "
+    >>> code += "import ner; print(time.time() - t)"
+    >>> took = float(subprocess.check_output([sys.executable, '-c', code],
+    ...                                      cwd=cwd))
+    >>> took < IMPORT_TIME_BUDGET
+    True
+    >>> code = "import sys, ner; print([m for m in ('spacy', 'flair', "
+    >>> code += "'torch', 'polyglot') if m in sys.modules])"
+    >>> subprocess.check_output([sys.executable, '-c', code], cwd=cwd)
+    b'[]\\n'
+    '''
+    return
+
+
 def test_all():
     '''
     Example usage:
@@ -858,5 +4220,4 @@ def test_all():
 
 
 if __name__ == '__main__':
-    import doctest
-    doctest.testmod(verbose=True)
+    sys.exit(main(sys.argv[1:]))
@@ -2,4 +2,4 @@
 cd /
 run_external_ners.sh
 cd /bin/
-gunicorn -w 1 ner:application -b :8099 -t 100
+gunicorn -c gunicorn.conf.py ner:application
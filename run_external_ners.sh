@@ -1,6 +1,14 @@
 #!/usr/bin/env bash
 
-(java -mx400m -cp stanford-ner-2018-10-16/stanford-ner.jar edu.stanford.nlp.ie.NERServer -outputFormat inlineXML -encoding "utf-8" -loadClassifier dutch.crf.gz -port 9092) &
+# Start one Stanford NERServer / Spotlight per port,
+# keep these in sync with STANFORD_BACKENDS / SPOTLIGHT_BACKENDS in ner.py.
+STANFORD_PORTS=${STANFORD_PORTS:-9092}
+SPOTLIGHT_PORTS=${SPOTLIGHT_PORTS:-9091}
 
-(/usr/lib/jvm/java-8-openjdk-amd64/bin/java -jar dbpedia-spotlight-1.0.0.jar nl http://localhost:9091/rest) &
+for port in $STANFORD_PORTS; do
+    (java -mx400m -cp stanford-ner-2018-10-16/stanford-ner.jar edu.stanford.nlp.ie.NERServer -outputFormat inlineXML -encoding "utf-8" -loadClassifier dutch.crf.gz -port $port) &
+done
 
+for port in $SPOTLIGHT_PORTS; do
+    (/usr/lib/jvm/java-8-openjdk-amd64/bin/java -jar dbpedia-spotlight-1.0.0.jar nl http://localhost:$port/rest) &
+done